@@ -1,25 +1,16 @@
 from pymongo import MongoClient
-import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tagtrials'))
+from preferred import dictionary_names, csv_names
+from tree import new_tree, tree_node, add_leaf, write_tree
+from visual_chem import load_chembl2pubchem, load_pubchem_clusters
 
 dburi = "mongodb://localhost/"
 dbname = "covidtag"
 c = MongoClient( dburi )
 db = c[ dbname ]
-pubchem_cluster = db['chemical_cluster'].find_one({'name': 'pubchem_cluster'})['data']
-
-def load_pubchem_mapping():
-    mapping = {}
-    for record in db['chemical_cluster'].find({'name': 'chembl2pubchem'}):
-        sub = record['data']
-        mapping = {**mapping, **sub}
-    return mapping
-
-def get_clusters(pubchem_id):
-    if pubchem_id:
-        exist = [x for x in pubchem_cluster if x['pubchem_id'] == pubchem_id]
-        if len(exist)>0:
-            return exist[0]['clusters']
-    return None    
 
 def get_tooltip(pubchem_id, compound, chembl, size):
     content = ''
@@ -33,22 +24,27 @@ def get_tooltip(pubchem_id, compound, chembl, size):
     return content
 
 def main():
-    pubchem_mapping = load_pubchem_mapping() 
+    pubchem_mapping = load_chembl2pubchem(db['chemical_cluster'])
+    pubchem_clusters = load_pubchem_clusters(db['chemical_cluster'])
+    # the first word of the chembl_dict entries, or a preferred name csv like chembl_preferred.csv
+    if len(sys.argv) > 1:
+        preferred = csv_names(sys.argv[1])
+    else:
+        preferred = dictionary_names(db['chembl_dict'])
     col = db['stat']
     doclist = col.find()
-    unknown = {'name' : 'unknown', 'children' :[]}
-    jobj = {'name': 'statistics', 'children' :[unknown]}
+    tree = new_tree()
+    tree_node(tree, ('unknown',))
     for doc in doclist:
         if doc['name'] == 'chembl':
             identifiers = doc['data']['top200_identifiers']
             for idf in identifiers:
                 for key in idf:
-                    record = db['chembl_dict'].find_one({'key': key})
-                    compound = record['words'][0]
+                    compound = preferred[key]
                     pubchem_id = ""
-                    if key in pubchem_mapping.keys():
+                    if key in pubchem_mapping:
                         pubchem_id = pubchem_mapping[key]
-                    clusters = get_clusters(pubchem_id)
+                    clusters = pubchem_clusters.get(pubchem_id, None)
                     size = idf[key]['trials']
                     leaf = {'chembl':key, 'name':compound, 'size': size} 
                     if len(pubchem_id)>0:
@@ -56,18 +52,10 @@ def main():
                     leaf['tooltip'] = get_tooltip(pubchem_id, compound, key, size)
                     if clusters:
                         for cltr in clusters:
-                            l1obj = None
-                            exist = [x for x in jobj["children"] if x['name'] == cltr]
-                            if len(exist) > 0:
-                                l1obj = exist[0]
-                            else:
-                                l1obj = {"name": cltr, "children": []}
-                                jobj["children"].append(l1obj)
-                            l1obj["children"].append(leaf)        
+                            add_leaf(tree, (cltr,), leaf)
                     else:
-                        unknown["children"].append(leaf)                
-    with open('chem_cluster.json', 'w') as outfile:
-        json.dump(jobj, outfile)
+                        add_leaf(tree, ('unknown',), leaf)
+    write_tree(tree, 'chem_cluster.json')
 
    
 
@@ -1,32 +1,26 @@
 from pymongo import MongoClient
-import json
+import csv
+from collections import Counter
 from datetime import datetime, timedelta, date
-from operator import itemgetter
 
 
 dburi = "mongodb://localhost/"
 dbname = 'nihtrial'
 STAT_COLLECTION = 'stat'
+# identifier -> trials index maintained by tagtrials
+INDEX_COLLECTION = 'trialindex'
 
 c = MongoClient( dburi )
 db = c[ dbname ]
 trial_collection = db['trial']
 
-trialfields = {'ctid': True, 'untagged.firstSubmittedDate': True, \
-    'untagged.firstPostedDate' : True, 'chembl_key': True, 'pdb_key': True, \
-    'primary_accession': True, 'pubchem_cid': True, '_id': False}
-tagdocs = []
+# only the submission dates are read from the trials, the chembl identifiers come from the index
+trialfields = {'ctid': True, 'untagged.firstSubmittedDate': True, '_id': False}
+submitted = {}
 for doc in trial_collection.find(filter=None, projection=trialfields ):
-    tagdocs.append(doc)
-
-with open('trial_tags.json', 'w') as outfile:
-    json.dump(tagdocs, outfile)
-
-for doc in tagdocs:
-    doc['submitted'] =  datetime.strptime(doc['untagged']['firstSubmittedDate'], '%B %d, %Y').date()
-    doc['posted'] = datetime.strptime(doc['untagged']['firstPostedDate'], '%B %d, %Y').date()
+    submitted[doc['ctid']] = datetime.strptime(doc['untagged']['firstSubmittedDate'], '%B %d, %Y').date()
 
-latest = max(tagdocs, key=itemgetter('submitted'))['submitted']
+latest = max(submitted.values())
 
 start = date.fromisoformat("2019-10-01")
 
@@ -40,39 +34,30 @@ while start < latest:
         periods.append({'start': start, 'end': end})
     start = end
 
-timeline = []
+# periods are whole months, a trial is counted in the month it was submitted
+timeline = {period['start']: Counter() for period in periods}
 
-for period in periods:
-    trials = [x for x in tagdocs if period['end'] > x['submitted'] >= period['start']]
-    chembls1 = {}
-    for doc in trials:
-        for ckey in doc['chembl_key']:
-            c_trial = chembls1.get(ckey, None)
-            if c_trial: 
-                chembls1[ckey] += 1
-            else:
-                chembls1[ckey] = 1
-    timeline.append( {'start': period['start'].isoformat(), 'chembl' : chembls1} )
+for doc in db[INDEX_COLLECTION].find({'name': 'chembl'}, projection={'_id': False, 'identifier': True, 'ctids': True}):
+    for ctid in doc['ctids']:
+        day = submitted.get(ctid, None)
+        if day:
+            chembls1 = timeline.get(day.replace(day = 1), None)
+            if chembls1 is not None:
+                chembls1[doc['identifier']] += 1
 
 chembls = set()
-for entry in timeline:
-    for key in entry['chembl'].keys():
-        chembls.add(key)
+for chembls1 in timeline.values():
+    chembls.update(chembls1.keys())
 
-from datetime import datetime, timedelta, date
 start = date.fromisoformat("2019-10-01")
 latest =  date.fromisoformat("2021-04-01")
-period_offset = 31 
-import csv
 
 with open('chembl_timeline.csv', 'w', newline='') as csvfile:
     writer = csv.writer(csvfile, delimiter=',',quotechar='|', quoting=csv.QUOTE_MINIMAL)
-    writer.writerow(['key','value','date])
+    writer.writerow(['key','value','date'])
     while start < latest:
-        records = [x for x in timeline if date.fromisoformat(x['start']) == start]
-        for r in records:
-            for ch in chembls:
-                cc = r["chembl"].get(ch, 0)
-                writer.writerow([ch, cc, start.isoformat()])
+        chembls1 = timeline.get(start, None)
+        if chembls1 is not None:
+            for ch in sorted(chembls):
+                writer.writerow([ch, chembls1[ch], start.isoformat()])
         start = (start + timedelta(days=period_offset)).replace(day = 1 )
-
@@ -20,7 +20,7 @@ def sync(src, dest, col):
             target = dest_coll.find_one(foid)
             if target:
                 if tsrc != target.get('timestamp', None) :
-                    dest_coll.update(foid, {"$set": src_coll.find_one(foid) }, upsert=False)
+                    dest_coll.replace_one(foid, src_coll.find_one(foid), upsert=False)
                     docid = doc.get('_id')
                     print (f'Doc {docid} updated.')
             else:
@@ -1,4 +1,4 @@
 #!/bin/bash
 docker run -d --network=host --name tagsrv \
   -v app.cfg:/app/tagger/app.cfg \
-  yan047/trialtagger:4 flask run --host=0.0.0.0
\ No newline at end of file
+  yan047/trialtagger:5 flask run --host=0.0.0.0
\ No newline at end of file
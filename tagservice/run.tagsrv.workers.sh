@@ -0,0 +1,5 @@
+#!/bin/bash
+docker run -d --network=host --name tagsrv \
+  -e TAGSRV_WORKERS=8 \
+  -v app.cfg:/app/tagger/app.cfg \
+  yan047/trialtagger:5 gunicorn -c gunicorn.conf.py webapp:app
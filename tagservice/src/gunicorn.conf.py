@@ -0,0 +1,36 @@
+# Production deployment of the tagging service:
+#   gunicorn -c gunicorn.conf.py webapp:app
+#
+# The app is preloaded, so the dictionaries are built once in the master and the
+# forked workers share their memory copy-on-write. The tagger engines live in C++
+# memory that reference counting does not touch, and gc.freeze() keeps the garbage
+# collector from writing to the Python objects loaded before the fork.
+# The master runs no threads and closes its MongoDB client before every fork, the
+# workers open their own. A worker that sees a changed dictionary sends SIGHUP to
+# the master, which reloads the changed dictionaries in on_reload and then forks
+# new workers with them in place of the old ones.
+import gc
+import multiprocessing
+import os
+
+os.environ['TAGSRV_PRELOAD'] = '1'
+
+bind = os.environ.get('TAGSRV_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('TAGSRV_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('TAGSRV_THREADS', 4))
+preload_app = True
+timeout = 300
+
+def on_reload(server):
+    import webapp
+    webapp.reload_in_master()
+
+def pre_fork(server, worker):
+    import webapp
+    webapp.close_db()
+    gc.freeze()
+
+def post_fork(server, worker):
+    import webapp
+    webapp.start_worker()
@@ -0,0 +1,48 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+class ResultCache:
+    """
+    LRU cache of the matches of a text with one dictionary, keyed by the hash
+    of the text and the dictionary version. Repeated text, like the boilerplate
+    of many trials, is only tagged once per dictionary version.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            matches = self.entries.get(key, None)
+            if matches is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return matches
+
+    def put(self, key, matches):
+        with self.lock:
+            self.entries[key] = matches
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), \
+                'max_size': self.max_entries}
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def result_key(text_hash, tgr):
+    return (text_hash, tgr['name'], tgr['blacklist_timestamp'], tgr['whitelist_timestamp'])
@@ -0,0 +1,94 @@
+import os
+import json
+
+import tagger
+
+# A snapshot keeps the names of a built engine in tagger's own entities/names
+# file format, so a restart loads them with Tagger.load_names instead of adding
+# every name from MongoDB again.
+SNAPSHOT_FORMAT = 1
+ENTITIES_FILE = '_entities.tsv'
+NAMES_FILE = '_names.tsv'
+META_FILE = '_meta.json'
+
+class SnapshotWriter:
+    """
+    Wraps a tagger while it is built, every name and blocked word passed to
+    the tagger is also written to the snapshot files of the dictionary.
+    """
+
+    def __init__(self, engine, snapshot_dir, name, meta):
+        os.makedirs(snapshot_dir, exist_ok=True)
+        self.engine = engine
+        self.meta = meta
+        self.path = os.path.join(snapshot_dir, name)
+        self.entities = {}
+        self.blocked = []
+        self.extra = []
+        self.names_file = open(self.path + NAMES_FILE + '.tmp', 'wb')
+
+    def add_name(self, name, entity_type, identifier):
+        self.engine.add_name(name, entity_type, identifier)
+        if has_separator(name) or has_separator(identifier):
+            # can not be written as a tsv line, kept in the meta file instead
+            self.extra.append([name.decode('utf-8'), entity_type, identifier.decode('utf-8')])
+            return
+        key = (entity_type, identifier)
+        serial = self.entities.get(key, None)
+        if serial is None:
+            serial = len(self.entities) + 1
+            self.entities[key] = serial
+        self.names_file.write(b'%d\t%s\n' % (serial, name))
+
+    def block_name(self, name, document_id):
+        self.engine.block_name(name, document_id)
+        self.blocked.append([name.decode('utf-8'), document_id])
+
+    def save(self, meta):
+        # the meta file is removed first and written last, a snapshot without
+        # a meta file is never loaded.
+        self.names_file.close()
+        meta_path = self.path + META_FILE
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        with open(self.path + ENTITIES_FILE + '.tmp', 'wb') as ef:
+            for key, serial in self.entities.items():
+                ef.write(b'%d\t%d\t%s\n' % (serial, key[0], key[1]))
+        os.replace(self.path + ENTITIES_FILE + '.tmp', self.path + ENTITIES_FILE)
+        os.replace(self.path + NAMES_FILE + '.tmp', self.path + NAMES_FILE)
+        meta = dict(self.meta, **meta)
+        meta.update(format=SNAPSHOT_FORMAT, blocked=self.blocked, extra=self.extra)
+        with open(meta_path + '.tmp', 'w') as mf:
+            json.dump(meta, mf)
+        os.replace(meta_path + '.tmp', meta_path)
+        return self.engine
+
+def has_separator(value):
+    return b'\t' in value or b'\n' in value
+
+def read_meta(snapshot_dir, name):
+    meta_path = os.path.join(snapshot_dir, name) + META_FILE
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as mf:
+        return json.load(mf)
+
+def load_snapshot(snapshot_dir, name, expected):
+    """
+    Returns the engine and meta data of the dictionary snapshot, or None when
+    there is no snapshot or any value of expected differs from its meta data.
+    """
+    meta = read_meta(snapshot_dir, name)
+    if meta is None or meta.get('format', None) != SNAPSHOT_FORMAT:
+        return None
+    for key in expected:
+        if meta.get(key, None) != expected[key]:
+            return None
+    path = os.path.join(snapshot_dir, name)
+    engine = tagger.Tagger()
+    engine.load_names(path + ENTITIES_FILE, path + NAMES_FILE)
+    for item in meta['extra']:
+        engine.add_name(item[0].encode('utf-8'), item[1], item[2].encode('utf-8'))
+    for item in meta['blocked']:
+        engine.block_name(item[0].encode('utf-8'), item[1])
+    return engine, meta
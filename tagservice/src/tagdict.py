@@ -1,5 +1,15 @@
 import tagger
 import datetime
+import hashlib
+import json
+import queue
+import re
+import threading
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import snapshot
 
 DOCUMENT_ID = 'doc'
 PRIMARY_ACCESSION = 'primary_accession'
@@ -7,52 +17,158 @@ TIMESTAMP_ELEMENT = 'timestamp'
 WORDS_ELEMENT = 'words'
 DEFAULT_TIMESTAMP = datetime.datetime(2020, 1, 1)
 str_DEFAULT_TIMESTAMP = DEFAULT_TIMESTAMP.isoformat()
+COMBINED_NAME = '*'
+# only the fields the engine needs are read from the dictionary collections
+PROTEIN_PROJECTION = {'_id': False, 'dictionary.' + PRIMARY_ACCESSION: True, 'dictionary.words': True}
+CHEMICAL_PROJECTION = {'_id': False, 'key': True, 'words': True}
+LOAD_BATCH_SIZE = 1000
+LOAD_PROGRESS = 1000000
+# chunks of encoded names waiting for the engine
+LOAD_QUEUE_SIZE = 8
+# seconds a full queue is waited for before the prefetch thread checks whether to stop
+LOAD_PUT_TIMEOUT = 1.0
+# longest wait in seconds before a dictionary version that failed to load is tried again
+RELOAD_BACKOFF_MAX = 3600
+
 def reload_new_dictionaries(context, taggers):
+    # a changed dictionary is built next to the one in use and then swapped in with
+    # a single list assignment, so requests always find either the old or the new one.
+    # returns the names of the reloaded dictionaries.
+    reloaded = []
     db = context['db']
     config_collection = context['config_collection']
     dict_defs = list ( db[config_collection].find( {'class':'dictionary'} ))
     logger = context['logger']
     for ddef in dict_defs:
+        name = ddef['name']
+        version = None
         try:
-            name = ddef['name']
-            search = [x for x in taggers if x['name'] == name]
-            re_create = True
-            if len(search) > 0:
-                t_inst = search[0]
-                if t_inst['blacklist_timestamp'] == get_last_timestamp(ddef['blacklist'], db) \
-                    and t_inst['whitelist_timestamp'] == get_last_timestamp(ddef['whitelist'], db):
-                    re_create = False
-                else:
-                    taggers.remove(t_inst)
-            if re_create:
-                if ddef['name'] =='protein':
-                    taggers.append(create_protein_tagger(ddef, context))
-                else:
-                    taggers.append(create_chem_tagger(ddef, context))  
-                msg = '\tdictionary ' + name + ' is reloaded!'
-                logger.info(msg)          
+            version = get_dictionary_version(ddef, db)
+            index = get_tagger_index(taggers, name)
+            if index is not None:
+                t_inst = taggers[index]
+                if (t_inst['blacklist_timestamp'], t_inst['whitelist_timestamp']) == version:
+                    continue
+            if is_backing_off(context, name, version):
+                continue
+            new_inst = create_tagger(ddef, context)
+            if index is None:
+                taggers.append(new_inst)
+            else:
+                taggers[index] = new_inst
+            clear_reload_failure(context, name)
+            reloaded.append(name)
+            msg = '\tdictionary ' + name + ' is reloaded!'
+            logger.info(msg)          
         except Exception as e:
             logger.error(e)
+            record_reload_failure(context, name, version)
+    return reloaded
+
+def record_reload_failure(context, name, version):
+    # the version that failed to load is not tried again before the retry time,
+    # the delay doubles with every failure of the same version up to RELOAD_BACKOFF_MAX.
+    if version is None:
+        return
+    cache = context['version_cache']
+    with cache['lock']:
+        failed = cache['failed'].get(name, None)
+        attempts = failed['attempts'] + 1 if failed and failed['version'] == version else 1
+        delay = min(context['version_ttl'] * 2 ** (attempts - 1), RELOAD_BACKOFF_MAX)
+        cache['failed'][name] = {'version': version, 'attempts': attempts, 'retry': time.time() + delay}
+    context['logger'].warning('dictionary ' + name + ' failed to load ' + str(attempts) + \
+            ' time(s), retried in ' + str(int(delay)) + ' seconds')
+
+def clear_reload_failure(context, name):
+    cache = context['version_cache']
+    with cache['lock']:
+        cache['failed'].pop(name, None)
+
+def is_backing_off(context, name, version):
+    failed = context['version_cache']['failed'].get(name, None)
+    return failed is not None and failed['version'] == version and time.time() < failed['retry']
+
+def get_tagger_index(taggers, name):
+    for index, tgr in enumerate(taggers):
+        if tgr['name'] == name:
+            return index
+    return None
 
 def get_last_timestamp(col_name, db):
     if len(col_name) >0:
-        latest = db[col_name].find().sort([(TIMESTAMP_ELEMENT, -1)]).limit(1)
-        if (latest.count()>0) :
-            return latest.next()[TIMESTAMP_ELEMENT].isoformat()
+        latest = db[col_name].find_one(sort=[(TIMESTAMP_ELEMENT, -1)], projection={TIMESTAMP_ELEMENT: True})
+        if latest:
+            return latest[TIMESTAMP_ELEMENT].isoformat()
     return str_DEFAULT_TIMESTAMP
 
+def create_version_cache():
+    # latest blacklist/whitelist timestamps of every dictionary, re-read from
+    # MongoDB when they are older than the TTL or a change stream marked them dirty,
+    # and the versions that failed to load, see record_reload_failure.
+    return {'lock': threading.Lock(), 'checked': 0.0, 'dirty': True, 'sources': {}, 'failed': {}}
+
+def get_source_versions(context):
+    cache = context['version_cache']
+    with cache['lock']:
+        if cache['dirty'] or time.time() - cache['checked'] >= context['version_ttl']:
+            # cleared before reading, a change arriving meanwhile is not lost
+            cache['dirty'] = False
+            cache['sources'] = read_source_versions(context)
+            cache['checked'] = time.time()
+        return cache['sources']
+
+def read_source_versions(context):
+    db = context['db']
+    dict_defs = db[context['config_collection']].find( {'class':'dictionary'} )
+    return {ddef['name']: get_dictionary_version(ddef, db) for ddef in dict_defs}
+
+def is_reload_needed(context, taggers):
+    # answered from the version cache, without MongoDB queries while it is fresh.
+    # a version that failed to load does not count until its retry time.
+    loaded = {x['name']: (x['blacklist_timestamp'], x['whitelist_timestamp']) for x in taggers}
+    for name, version in get_source_versions(context).items():
+        if version != loaded.get(name, None) and not is_backing_off(context, name, version):
+            return True
+    return False
+
+def get_loaded_version(taggers):
+    # milliseconds since epoch of the newest blacklist/whitelist of the loaded dictionaries,
+    # the same in every process that loaded the same dictionary versions.
+    timestamps = [x[k] for x in taggers for k in ('blacklist_timestamp', 'whitelist_timestamp') if x[k]]
+    newest = datetime.datetime.fromisoformat(max(timestamps, default=str_DEFAULT_TIMESTAMP))
+    return int(newest.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+def watch_dictionary_changes(context):
+    # marks the version cache dirty on every change of the dictionary configuration
+    # and lists, change streams need a replica set, otherwise only the TTL applies.
+    db = context['db']
+    logger = context['logger']
+    names = set([context['config_collection']])
+    for ddef in db[context['config_collection']].find( {'class':'dictionary'} ):
+        names.update(x for x in (ddef['blacklist'], ddef['whitelist']) if len(x) > 0)
+    try:
+        with db.watch([{'$match': {'ns.coll': {'$in': list(names)}}}]) as stream:
+            logger.info('watching dictionary changes in ' + ', '.join(sorted(names)))
+            for change in stream:
+                context['version_cache']['dirty'] = True
+    except PyMongoError as e:
+        logger.warning('dictionary change stream stopped, versions are checked every ' \
+                + str(context['version_ttl']) + ' seconds: ' + str(e))
+
 def create_taggers(context):
     db = context['db']
     config_collection = context['config_collection']
     dict_defs = list ( db[config_collection].find( {'class':'dictionary'} ))
     taggers = []
     for ddef in dict_defs:
-        if ddef['name'] =='protein':
-            taggers.append(create_protein_tagger(ddef, context))
-        else :
-            taggers.append(create_chem_tagger(ddef, context))
+        taggers.append(create_tagger(ddef, context))
     return taggers
 
+def create_tagger(ddef, context):
+    if ddef['name'] =='protein':
+        return create_protein_tagger(ddef, context)
+    return create_chem_tagger(ddef, context)
+
 def create_tgr(name, engine, entity_types, black_timestamp, white_timestamp):
     tgr_inst = {'name': name, 'engine' : engine, 'entity_types': entity_types}
     if black_timestamp:
@@ -68,51 +184,203 @@ def create_tgr(name, engine, entity_types, black_timestamp, white_timestamp):
 def create_protein_tagger(ddef, context):
     logger = context['logger']
     logger.info('create tagger for dictionary ' + ddef['name'])
-    engine, black_timestamp, white_timestamp = create_protein_engine(ddef, context)
+    engine, black_timestamp, white_timestamp = load_engine_snapshot(ddef, context)
+    if engine is None:
+        engine, black_timestamp, white_timestamp = create_protein_engine(ddef, context)
     entity_types = set([ddef['entity_type']])
     return create_tgr(ddef['name'], engine, entity_types, black_timestamp, white_timestamp)
 
 def create_chem_tagger(ddef, context):
     logger = context['logger']
     logger.info('create tagger for dictionary ' + ddef['name'])
-    engine, black_timestamp, white_timestamp = create_chemical_engine(ddef, context)
+    engine, black_timestamp, white_timestamp = load_engine_snapshot(ddef, context)
+    if engine is None:
+        engine, black_timestamp, white_timestamp = create_chemical_engine(ddef, context)
     entity_types = set([ddef['entity_type']])
     return create_tgr(ddef['name'], engine, entity_types, black_timestamp, white_timestamp)
 
+def get_dictionary_version(ddef, db):
+    # the blacklist and whitelist timestamps an engine built now would have
+    black_timestamp = str_DEFAULT_TIMESTAMP
+    if len(ddef['blacklist']) > 0:
+        black_timestamp = get_last_timestamp(ddef['blacklist'], db)
+    white_timestamp = str_DEFAULT_TIMESTAMP
+    if ddef.get('whitelist_items', None):
+        white_timestamp = get_last_timestamp(ddef['whitelist'], db)
+    return black_timestamp, white_timestamp
+
+def get_source_hash(ddef, db):
+    # hash of the dictionary definition and the content of its dictionary collection
+    ddef_items = {k: v for k, v in ddef.items() if k != '_id'}
+    sha = hashlib.sha1(json.dumps(ddef_items, sort_keys=True, default=str).encode('utf-8'))
+    dict_c_name = ddef['dictionary_collection']
+    if len(dict_c_name) > 0:
+        try:
+            c_hash = db.command('dbHash', collections=[dict_c_name])['collections'].get(dict_c_name, '')
+        except OperationFailure:
+            # dbHash is not allowed, fall back to the size and the newest document
+            last = db[dict_c_name].find_one(sort=[('_id', -1)], projection={'_id': True})
+            c_hash = str(db[dict_c_name].count_documents({})) + ':' + str(last['_id'] if last else '')
+        sha.update(c_hash.encode('utf-8'))
+    return sha.hexdigest()
+
+def load_engine_snapshot(ddef, context):
+    # returns (None, None, None) when snapshots are disabled, missing or outdated
+    snapshot_dir = context.get('snapshot_dir', '')
+    if len(snapshot_dir) == 0:
+        return None, None, None
+    db = context['db']
+    logger = context['logger']
+    black_timestamp, white_timestamp = get_dictionary_version(ddef, db)
+    loaded = snapshot.load_snapshot(snapshot_dir, ddef['name'], {'blacklist_timestamp': black_timestamp, \
+                'whitelist_timestamp': white_timestamp, 'source_hash': get_source_hash(ddef, db)})
+    if loaded is None:
+        logger.info('\tno up-to-date snapshot of dictionary ' + ddef['name'])
+        return None, None, None
+    logger.info('\tdictionary ' + ddef['name'] + ' is loaded from snapshot.')
+    return loaded[0], black_timestamp, white_timestamp
+
+def new_engine(ddef, context):
+    tgr = tagger.Tagger()
+    snapshot_dir = context.get('snapshot_dir', '')
+    if len(snapshot_dir) > 0:
+        # the source hash is taken before the dictionary is read
+        return snapshot.SnapshotWriter(tgr, snapshot_dir, ddef['name'], \
+                    {'name': ddef['name'], 'source_hash': get_source_hash(ddef, context['db'])})
+    return tgr
+
+def finish_engine(tgr, ddef, context, black_timestamp, white_timestamp):
+    if isinstance(tgr, snapshot.SnapshotWriter):
+        context['logger'].info('\tsave snapshot of dictionary ' + ddef['name'])
+        return tgr.save({'blacklist_timestamp': black_timestamp, 'whitelist_timestamp': white_timestamp})
+    return tgr
+
 def create_protein_engine(ddef, context):
     db = context['db']
     logger = context['logger']
     logger.info('preparing protein engine...')
+    log_collection_names(ddef, logger)
+    tgr = new_engine(ddef, context)
+    load_protein_dictionary(ddef, context, tgr)
+    black_timestamp = tagger_block_blacklist(db[ddef['blacklist']], tgr)
+    white_timestamp = load_whitelist(ddef, db, tgr)
+    return finish_engine(tgr, ddef, context, black_timestamp, white_timestamp), black_timestamp, white_timestamp
+
+def log_collection_names(ddef, logger):
+    logger.info('\tdictionary collection name is: ' + ddef['dictionary_collection'])
+    logger.info('\tblacklist collection name is: ' + ddef['blacklist'])
+    logger.info('\twhitelist collection name is: ' + ddef['whitelist'])
+
+def load_protein_dictionary(ddef, context, tgr):
+    cursor = context['db'][ddef['dictionary_collection']].find(projection=PROTEIN_PROJECTION, \
+                batch_size=context.get('load_batch_size', LOAD_BATCH_SIZE))
+    with cursor:
+        load_names(protein_names(cursor), ddef, context, tgr)
+
+def load_chemical_dictionary(ddef, context, tgr):
     dict_c_name = ddef['dictionary_collection']
-    logger.info('\tdictionary collection name is: ' + dict_c_name) 
-    blacklist_name = ddef['blacklist']
-    logger.info('\tblacklist collection name is: ' + blacklist_name) 
-    whitelist_name = ddef['whitelist'] 
-    logger.info('\twhitelist collection name is: ' + whitelist_name)    
-    entity_type = ddef['entity_type']
+    if len(dict_c_name) > 0:
+        cursor = context['db'][dict_c_name].find(projection=CHEMICAL_PROJECTION, \
+                    batch_size=context.get('load_batch_size', LOAD_BATCH_SIZE))
+        with cursor:
+            load_names(chemical_names(cursor), ddef, context, tgr)
 
-    tgr = tagger.Tagger()
-    for edict in db[dict_c_name].find():
+def load_dictionary(ddef, context, tgr):
+    if ddef['name'] == 'protein':
+        load_protein_dictionary(ddef, context, tgr)
+    else:
+        load_chemical_dictionary(ddef, context, tgr)
+
+def protein_names(cursor):
+    # (key, [name, ...]) of every entry, utf-8 encoded for the engine
+    for edict in cursor:
         for entry in edict['dictionary']:
-            p_a = entry[PRIMARY_ACCESSION].encode("utf-8")
-            for word in entry['words']:
-                tgr.add_name(word.encode("utf-8"), entity_type, p_a)
+            yield entry[PRIMARY_ACCESSION].encode("utf-8"), [w.encode("utf-8") for w in entry['words']]
 
-    black_timestamp = tagger_block_blacklist(db[blacklist_name], tgr)
-    white_timestamp = str_DEFAULT_TIMESTAMP
+def chemical_names(cursor):
+    for entry in cursor:
+        yield entry['key'].encode("utf-8"), [w.encode("utf-8") for w in entry['words']]
+
+def prefetch_names(names, chunk_size):
+    # reads and encodes the names in a thread while the caller adds the previous
+    # chunk to the engine, the engine itself is only used by the caller's thread.
+    # closing the generator stops the thread and waits for it, so the caller
+    # can close the cursor afterwards even when adding the names failed.
+    chunks = queue.Queue(maxsize=LOAD_QUEUE_SIZE)
+    stop = threading.Event()
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=LOAD_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            chunk = []
+            for item in names:
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    if not put(chunk):
+                        return
+                    chunk = []
+            if put(chunk):
+                put(None)
+        except Exception as e:
+            put(e)
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield from chunk
+    finally:
+        stop.set()
+        thread.join()
+
+def load_names(names, ddef, context, tgr):
+    logger = context['logger']
+    entity_type = ddef['entity_type']
+    progress = context.get('load_progress', LOAD_PROGRESS)
+    if context.get('load_parallel', False):
+        names = prefetch_names(names, context.get('load_batch_size', LOAD_BATCH_SIZE))
+    start = time.time()
+    n_keys = 0
+    n_names = 0
+    next_report = progress
+    try:
+        for c_key, words in names:
+            for word in words:
+                tgr.add_name(word, entity_type, c_key)
+            n_keys += 1
+            n_names += len(words)
+            if progress > 0 and n_names >= next_report:
+                logger.info(f'\t{ddef["name"]}: {n_names} names of {n_keys} entities loaded in {time.time() - start:.1f}s')
+                next_report = n_names + progress
+    finally:
+        names.close()
+    elapsed = time.time() - start
+    logger.info(f'\tdictionary {ddef["name"]}: {n_names} names of {n_keys} entities loaded in {elapsed:.1f}s' \
+                + f' ({n_names / elapsed if elapsed > 0 else 0:.0f} names/s)')
+
+def load_whitelist(ddef, db, tgr):
+    whitelist_name = ddef['whitelist']
     wlitems = ddef.get('whitelist_items', None)
     if len(whitelist_name) > 0 and wlitems:
-        white_timestamp = tagger_add_whitelist(db[whitelist_name], tgr, entity_type,  \
+        return tagger_add_whitelist(db[whitelist_name], tgr, ddef['entity_type'], \
             wlitems[0], wlitems[1])
-    return tgr, black_timestamp, white_timestamp
+    return str_DEFAULT_TIMESTAMP
 
 def tagger_block_blacklist(blist_c, tgr):
     # get blacklist
-    blacklist = {}
-    latest = blist_c.find().sort([(TIMESTAMP_ELEMENT, -1)]).limit(1)
-    if (latest.count()>0) :
-        blacklist = latest.next()
-    else :
+    blacklist = blist_c.find_one(sort=[(TIMESTAMP_ELEMENT, -1)])
+    if blacklist is None:
+        blacklist = {}
         blacklist[WORDS_ELEMENT] = ''
         blacklist[TIMESTAMP_ELEMENT] = DEFAULT_TIMESTAMP
     # blocking
@@ -122,11 +390,9 @@ def tagger_block_blacklist(blist_c, tgr):
 
 def tagger_add_whitelist(wlist_c, tgr, entity_type, key_name, word_name):
     # get whitelist
-    whitelist = {}
-    latest = wlist_c.find().sort([(TIMESTAMP_ELEMENT, -1)]).limit(1)
-    if (latest.count()>0) :
-        whitelist = latest.next()
-    else :
+    whitelist = wlist_c.find_one(sort=[(TIMESTAMP_ELEMENT, -1)])
+    if whitelist is None:
+        whitelist = {}
         whitelist['dictionary'] = []
         whitelist[TIMESTAMP_ELEMENT] = DEFAULT_TIMESTAMP
     # adding new words in whitelist
@@ -140,26 +406,88 @@ def create_chemical_engine(ddef, context):
     db = context['db']
     logger = context['logger']    
     logger.info ('preparing chemical engine...')
-    dict_c_name = ddef['dictionary_collection']
-    logger.info ('\tdictionary collection name is: ' + dict_c_name) 
-    blacklist_name = ddef['blacklist']
-    logger.info ('\tblacklist collection name is: ' + blacklist_name) 
-    whitelist_name = ddef['whitelist'] 
-    logger.info ('\twhitelist collection name is: ' + whitelist_name)
-    entity_type = ddef['entity_type']
-    tgr = tagger.Tagger()
-    if len(dict_c_name) > 0:
-        for entry in db[dict_c_name].find():
-            c_key = entry['key'].encode("utf-8")
-            for word in entry['words']:
-                tgr.add_name(word.encode("utf-8"), entity_type, c_key)
+    log_collection_names(ddef, logger)
+    tgr = new_engine(ddef, context)
+    load_chemical_dictionary(ddef, context, tgr)
     black_timestamp = str_DEFAULT_TIMESTAMP
-    if len(blacklist_name) > 0:
-        black_timestamp = tagger_block_blacklist(db[blacklist_name], tgr)
-    white_timestamp = str_DEFAULT_TIMESTAMP
-    wlitems = ddef.get('whitelist_items', None)
-    if len(whitelist_name) > 0 and wlitems:
-        white_timestamp = tagger_add_whitelist(db[whitelist_name], tgr, entity_type, \
-                wlitems[0], wlitems[1])
+    if len(ddef['blacklist']) > 0:
+        black_timestamp = tagger_block_blacklist(db[ddef['blacklist']], tgr)
+    white_timestamp = load_whitelist(ddef, db, tgr)
     logger.info ('\tload chemical dictionary completed.')
-    return tgr, black_timestamp, white_timestamp
+    return finish_engine(tgr, ddef, context, black_timestamp, white_timestamp), black_timestamp, white_timestamp
+
+def get_list_document(col_name, db, version):
+    # the list document of a version, an empty list for the default version and
+    # None when the version is not found anymore.
+    if len(col_name) == 0 or version in ('', str_DEFAULT_TIMESTAMP):
+        return {}
+    return db[col_name].find_one({TIMESTAMP_ELEMENT: datetime.datetime.fromisoformat(version)})
+
+def get_whitelist_names(whitelist, ddef):
+    wlitems = ddef.get('whitelist_items', None)
+    names = set()
+    if wlitems:
+        for grp in whitelist.get('dictionary', None) or []:
+            for word in grp[wlitems[1]]:
+                names.add((grp[wlitems[0]], word))
+    return names
+
+def get_list_diff(ddef, db, from_version, to_version):
+    # words blocked and unblocked, names added to and removed from the whitelist
+    # between two (blacklist, whitelist) versions of a dictionary, None when the
+    # list document of a version is not found.
+    black_from = get_list_document(ddef['blacklist'], db, from_version[0])
+    black_to = get_list_document(ddef['blacklist'], db, to_version[0])
+    white_from = get_list_document(ddef['whitelist'], db, from_version[1])
+    white_to = get_list_document(ddef['whitelist'], db, to_version[1])
+    if black_from is None or black_to is None or white_from is None or white_to is None:
+        return None
+    old_words = set(black_from.get(WORDS_ELEMENT, None) or [])
+    new_words = set(black_to.get(WORDS_ELEMENT, None) or [])
+    old_names = get_whitelist_names(white_from, ddef)
+    new_names = get_whitelist_names(white_to, ddef)
+    return {'blocked': sorted(new_words - old_words), 'unblocked': sorted(old_words - new_words), \
+            'whitelisted': [list(x) for x in sorted(new_names - old_names)], \
+            'unwhitelisted': [list(x) for x in sorted(old_names - new_names)]}
+
+def get_blacklist_words(blist_c):
+    blacklist = blist_c.find_one(sort=[(TIMESTAMP_ELEMENT, -1)])
+    if blacklist:
+        return blacklist[WORDS_ELEMENT]
+    return []
+
+def normalize_name(name):
+    # the engines match names case-insensitively and whatever whitespace or hyphens
+    # separate their words, blacklisted words are compared the same way.
+    return re.sub(r'[\s\-]+', ' ', name).strip().casefold()
+
+def create_combined_tagger(context):
+    # one engine holding every dictionary, each with its own entity type. Blacklists
+    # can not be blocked per dictionary inside a shared engine, they are kept as
+    # sets of normalized words and applied to the matches instead.
+    # returns None when two dictionaries share an entity type, their matches could
+    # not be told apart.
+    db = context['db']
+    logger = context['logger']
+    logger.info('create combined tagger for all dictionaries')
+    dict_defs = list ( db[context['config_collection']].find( {'class':'dictionary'} ))
+    entity_types = [ddef['entity_type'] for ddef in dict_defs]
+    if len(set(entity_types)) < len(entity_types):
+        logger.error('dictionaries share an entity type, the combined tagger is not created')
+        return None
+    tgr = tagger.Tagger()
+    dictionaries = {}
+    blacklists = {}
+    versions = {}
+    for ddef in dict_defs:
+        name = ddef['name']
+        versions[name] = get_dictionary_version(ddef, db)
+        load_dictionary(ddef, context, tgr)
+        load_whitelist(ddef, db, tgr)
+        dictionaries[ddef['entity_type']] = name
+        blacklists[name] = set()
+        if len(ddef['blacklist']) > 0:
+            blacklists[name] = set(normalize_name(w) for w in get_blacklist_words(db[ddef['blacklist']]))
+    logger.info('\tcombined tagger completed.')
+    return {'name': COMBINED_NAME, 'engine': tgr, 'entity_types': set(dictionaries), \
+            'dictionaries': dictionaries, 'blacklists': blacklists, 'versions': versions}
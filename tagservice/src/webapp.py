@@ -3,10 +3,18 @@ from flask import request
 from flask import jsonify
 
 import logging
+import gzip
+import os
+import json
+import signal
+import threading
+import uuid
+from datetime import datetime
 
 from pymongo import MongoClient
 
 import tagdict
+from resultcache import ResultCache, text_hash, result_key
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
@@ -18,21 +26,98 @@ app.logger.info('MONGODB_DB =' + app.config['MONGODB_DB'])
 app.logger.info('MONGODB_PORT =' + app.config['MONGODB_PORT'])
 app.logger.info('MONGODB_CONFIG =' + app.config['MONGODB_CONFIG'])
 
-c = MongoClient(app.config['MONGODB_SERVER'], int(app.config['MONGODB_PORT']))
+# set by gunicorn.conf.py: the dictionaries are loaded once in the gunicorn master
+# and shared copy-on-write by the forked workers, only the master reloads them.
+PRELOADED = os.environ.get('TAGSRV_PRELOAD', '') == '1'
+# id of the reload job of a preloaded deployment, which runs in the gunicorn master
+MASTER_JOB_ID = 'master'
 
-context = {'db': c[app.config['MONGODB_DB']] , 'logger': app.logger, \
-            'config_collection': app.config['MONGODB_CONFIG']}
+mongo = {'client': None}
 
+context = {'db': None, 'logger': app.logger, \
+            'config_collection': app.config['MONGODB_CONFIG'], \
+            'snapshot_dir': app.config.get('SNAPSHOT_DIR', ''), \
+            'version_cache': tagdict.create_version_cache(), \
+            'version_ttl': float(app.config.get('VERSION_TTL', 60)), \
+            'load_batch_size': int(app.config.get('LOAD_BATCH_SIZE', tagdict.LOAD_BATCH_SIZE)), \
+            'load_parallel': str(app.config.get('LOAD_PARALLEL', 'False')).lower() == 'true', \
+            'load_progress': int(app.config.get('LOAD_PROGRESS', tagdict.LOAD_PROGRESS))}
+
+def connect_db():
+    # every process opens its own client, pymongo clients must not be shared across a fork
+    mongo['client'] = MongoClient(app.config['MONGODB_SERVER'], int(app.config['MONGODB_PORT']))
+    context['db'] = mongo['client'][app.config['MONGODB_DB']]
+
+def close_db():
+    if mongo['client'] is not None:
+        mongo['client'].close()
+        mongo['client'] = None
+
+connect_db()
 taggers = tagdict.create_taggers(context)
+# optional single engine with every dictionary, used when a request asks for several dictionaries
+COMBINED_TAGGER = str(app.config.get('COMBINED_TAGGER', 'False')).lower() == 'true'
+combined = {'tagger': None}
+if COMBINED_TAGGER:
+    combined['tagger'] = tagdict.create_combined_tagger(context)
+VERSION_WATCH = str(app.config.get('VERSION_WATCH', 'False')).lower() == 'true'
+
+def start_watcher():
+    if VERSION_WATCH:
+        threading.Thread(target=tagdict.watch_dictionary_changes, args=(context,), daemon=True).start()
+
+# a preloaded master runs no threads, the workers start theirs after the fork
+if not PRELOADED:
+    start_watcher()
 
 DOCUMENT_ID = 'doc'
 QUERY_DOC = 'doc'
 QUERY_DICTIONARY = 'dict'
+QUERY_DOCS = 'docs'
+QUERY_DICTIONARIES = 'dicts'
+DOC_ID = 'id'
+DOC_TEXT = 'text'
+MAX_FINISHED_JOBS = 20
+
+# dictionary reload jobs, at most one is running at a time
+jobs = {}
+jobs_lock = threading.Lock()
+GZIP_MIN_SIZE = int(app.config.get('GZIP_MIN_SIZE', 1024))
+# matches by text hash and dictionary version, cleared when dictionaries are reloaded
+RESULT_CACHE_SIZE = int(app.config.get('RESULT_CACHE_SIZE', 0))
+result_cache = ResultCache(RESULT_CACHE_SIZE) if RESULT_CACHE_SIZE > 0 else None
+
+def get_query():
+    # request bodies may be sent gzip compressed by the clients
+    if request.headers.get('Content-Encoding', '') == 'gzip':
+        return json.loads(gzip.decompress(request.get_data()))
+    return request.get_json(force = True)
+
+@app.after_request
+def compress_response(response):
+    if GZIP_MIN_SIZE < 0 or response.direct_passthrough or 'Content-Encoding' in response.headers \
+        or 'gzip' not in request.headers.get('Accept-Encoding', ''):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 @app.route('/tag', methods=['POST'])
 def tag():
-    query = request.get_json(force = True)
-    tgr = get_tagger(query[QUERY_DICTIONARY])
+    # 'dict' is a dictionary name, a list of names or '*' for all dictionaries,
+    # the matches of several dictionaries are keyed by dictionary name.
+    query = get_query()
+    names = query[QUERY_DICTIONARY]
+    if isinstance(names, list) or names == tagdict.COMBINED_NAME:
+        tgrs = get_taggers(names)
+        if tgrs is None:
+            return {'error': 'Unknown dictionary.'}
+        return {'match': tag_text_cached(tgrs, query[QUERY_DOC])}
+    tgr = get_tagger(names)
     response = {}
     if tgr:
         response['match'] = tag_text(tgr, query[QUERY_DOC])
@@ -40,21 +125,168 @@ def tag():
         response = {'error': 'Unknown dictionary.'}
     return response
 
+@app.route('/tag/batch', methods=['POST'])
+def tag_batch():
+    # tag a list of {id, text} documents with a list of dictionaries in one request,
+    # the matches are keyed by document id and then by dictionary name.
+    # a document may list its own 'dicts', a subset of the dictionaries of the request.
+    # the versions of the dictionaries used are returned with the matches.
+    query = get_query()
+    tgrs = get_taggers(query[QUERY_DICTIONARIES])
+    if tgrs is None:
+        return {'error': 'Unknown dictionary.'}
+    matches = {}
+    for doc in query[QUERY_DOCS]:
+        doc_tgrs = tgrs
+        if QUERY_DICTIONARIES in doc:
+            doc_tgrs = [x for x in tgrs if x['name'] in doc[QUERY_DICTIONARIES]]
+        matches[doc[DOC_ID]] = tag_text_cached(doc_tgrs, doc[DOC_TEXT])
+    return {'match': matches, 'dictionaries': [get_tagger_info(tgr) for tgr in tgrs]}
+
 @app.route('/dictionaries/update', methods=['POST'])
 def update_dictionaries():
-    tagdict.reload_new_dictionaries(context, taggers)
-    app.logger.info('All dictionaries are up-to-date!')
-    return get_all_dicts_info()
+    # changed dictionaries are reloaded in the background, the dictionaries
+    # in use keep serving requests until the new ones are swapped in.
+    # Nothing is started while the cached versions match the loaded dictionaries.
+    # A preloaded worker asks the gunicorn master to reload and restart the workers.
+    job = get_running_job()
+    if job is None and tagdict.is_reload_needed(context, taggers):
+        job = signal_master_reload() if PRELOADED else start_reload_job()
+    response = get_all_dicts_info()
+    if job:
+        response['job'] = get_job_info(job)
+    return response
+
+@app.route('/dictionaries/jobs/<job_id>', methods=['GET'])
+def dictionaries_job(job_id):
+    if PRELOADED and job_id == MASTER_JOB_ID:
+        return get_master_job_info()
+    job = jobs.get(job_id, None)
+    if job is None:
+        return {'error': 'Unknown job.'}, 404
+    return get_job_info(job)
+
+def get_running_job():
+    running = [x for x in list(jobs.values()) if x['status'] == 'running']
+    if len(running) > 0:
+        return running[0]
+    return None
+
+def start_reload_job():
+    with jobs_lock:
+        running = get_running_job()
+        if running:
+            return running
+        job = new_job()
+    threading.Thread(target=run_reload_job, args=(job,), daemon=True).start()
+    return job
+
+def new_job(job_id=None):
+    finished = sorted((x for x in jobs.values()), key=lambda x: x['started'])
+    for job in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+        del jobs[job['id']]
+    job = {'id': job_id or uuid.uuid4().hex, 'status': 'running', 'started': datetime.now().isoformat(), \
+            'finished': None, 'reloaded': [], 'error': None}
+    jobs[job['id']] = job
+    return job
+
+def signal_master_reload():
+    # the master reloads the changed dictionaries on SIGHUP and then forks new workers
+    # in place of this one, the job stays running here until the worker is replaced.
+    with jobs_lock:
+        running = get_running_job()
+        if running:
+            return running
+        job = new_job(MASTER_JOB_ID)
+    os.kill(os.getppid(), signal.SIGHUP)
+    return job
+
+def get_master_job_info():
+    # answered by any worker: the one that signalled the master still has the running job,
+    # a worker forked after the reload serves the dictionaries the master could load.
+    job = jobs.get(MASTER_JOB_ID, None)
+    if job is not None:
+        return get_job_info(job)
+    job = {'id': MASTER_JOB_ID, 'status': 'done', 'started': None, 'finished': None, 'reloaded': [], 'error': None}
+    failed = sorted(context['version_cache']['failed'])
+    if tagdict.is_reload_needed(context, taggers):
+        job['status'] = 'running'
+    elif len(failed) > 0:
+        job['status'] = 'failed'
+        job['error'] = 'dictionaries failed to load: ' + ', '.join(failed)
+    return job
+
+def reload_in_master():
+    # called by gunicorn.conf.py in the master on SIGHUP, before the new workers are forked
+    connect_db()
+    try:
+        reload_dictionaries()
+        app.logger.info('All dictionaries are up-to-date!')
+    except Exception as e:
+        app.logger.error(e)
+    finally:
+        close_db()
+
+def start_worker():
+    # called by gunicorn.conf.py in every forked worker
+    connect_db()
+    start_watcher()
+
+def reload_dictionaries():
+    reloaded = tagdict.reload_new_dictionaries(context, taggers)
+    if len(reloaded) > 0:
+        if result_cache:
+            result_cache.clear()
+        if COMBINED_TAGGER:
+            combined['tagger'] = tagdict.create_combined_tagger(context)
+    return reloaded
+
+def run_reload_job(job):
+    try:
+        job['reloaded'] = reload_dictionaries()
+        job['status'] = 'done'
+        app.logger.info('All dictionaries are up-to-date!')
+    except Exception as e:
+        app.logger.error(e)
+        job['error'] = str(e)
+        job['status'] = 'failed'
+    job['finished'] = datetime.now().isoformat()
+
+def get_job_info(job):
+    return dict(job)
 
 @app.route('/dictionaries', methods=['GET'])
 def dictionaries():
     return get_all_dicts_info()
 
+@app.route('/dictionaries/<name>/diff', methods=['GET'])
+def dictionary_diff(name):
+    # list changes from the version given by the blacklist and whitelist
+    # timestamps in the query to the loaded version of the dictionary
+    tgr = get_tagger(name)
+    if tgr is None:
+        return {'error': 'Unknown dictionary.'}, 404
+    db = context['db']
+    ddef = db[context['config_collection']].find_one({'class': 'dictionary', 'name': name})
+    from_version = (request.args.get('blacklist', ''), request.args.get('whitelist', ''))
+    to_version = (tgr['blacklist_timestamp'], tgr['whitelist_timestamp'])
+    diff = tagdict.get_list_diff(ddef, db, from_version, to_version) if ddef else None
+    if diff is None:
+        return {'error': 'Unknown list version.'}, 404
+    diff.update(get_tagger_info(tgr))
+    return diff
+
+@app.route('/cache', methods=['GET'])
+def cache():
+    if result_cache is None:
+        return {'error': 'The result cache is disabled.'}, 404
+    return result_cache.info()
+
 def get_all_dicts_info():
     response = []
     for tgr in taggers:
         response.append( get_tagger_info(tgr) )
-    return {'dictionaries': response}
+    return {'dictionaries': response, 'version': tagdict.get_loaded_version(taggers)}
 
 def get_tagger_info(tgr):
     tgr_info = {'name': tgr['name'], 'entity_types':list(tgr['entity_types'])[0]}
@@ -68,9 +300,69 @@ def get_tagger(dict_name):
             return tgr
     return None
 
+def get_taggers(names):
+    if names == tagdict.COMBINED_NAME:
+        return list(taggers)
+    tgrs = []
+    for name in names:
+        tgr = get_tagger(name)
+        if tgr is None:
+            return None
+        tgrs.append(tgr)
+    return tgrs
+
 def tag_text(tgr, text):
     engine = tgr['engine']
     return engine.get_matches(document=text, document_id=DOCUMENT_ID, entity_types= tgr['entity_types'])
 
+def tag_text_cached(tgrs, text):
+    # only the dictionaries without cached matches of the text are run
+    if result_cache is None:
+        return tag_text_dicts(tgrs, text)
+    thash = text_hash(text)
+    matches = {}
+    missing = []
+    for tgr in tgrs:
+        found = result_cache.get(result_key(thash, tgr))
+        if found is None:
+            missing.append(tgr)
+        else:
+            matches[tgr['name']] = found
+    if len(missing) > 0:
+        tagged = tag_text_dicts(missing, text)
+        for tgr in missing:
+            result_cache.put(result_key(thash, tgr), tagged[tgr['name']])
+        matches.update(tagged)
+    return {tgr['name']: matches[tgr['name']] for tgr in tgrs}
+
+def tag_text_dicts(tgrs, text):
+    # several dictionaries scan the text once with the combined engine, when it is
+    # loaded with the same dictionary versions (it is rebuilt after a reload).
+    ctgr = combined['tagger']
+    if ctgr is None or len(tgrs) < 2 or not is_combined_current(ctgr, tgrs):
+        return {tgr['name']: tag_text(tgr, text) for tgr in tgrs}
+    return tag_text_combined(ctgr, [tgr['name'] for tgr in tgrs], text)
+
+def is_combined_current(ctgr, tgrs):
+    for tgr in tgrs:
+        version = ctgr['versions'].get(tgr['name'], None)
+        if version != (tgr['blacklist_timestamp'], tgr['whitelist_timestamp']):
+            return False
+    return True
+
+def tag_text_combined(ctgr, names, text):
+    types = set(x for x in ctgr['entity_types'] if ctgr['dictionaries'][x] in names)
+    matches = {name: [] for name in names}
+    for m in tag_text({'engine': ctgr['engine'], 'entity_types': types}, text):
+        word = tagdict.normalize_name(text[m[0]:m[1]+1])
+        split = {}
+        for en in m[2]:
+            name = ctgr['dictionaries'][en[0]]
+            if word not in ctgr['blacklists'][name]:
+                split.setdefault(name, []).append(en)
+        for name in split:
+            matches[name].append((m[0], m[1], split[name]))
+    return matches
+
 if __name__ == '__main__':
     app.run()
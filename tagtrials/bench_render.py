@@ -0,0 +1,90 @@
+import sys
+import time
+import random
+
+from render import render_tagged, LINK_TEMPLATES
+from tag import TRIAL_ELEMENTS
+
+'''
+Times the rendering of the tagged text of synthetic trials with growing
+detailedDescription fields, with the old string concatenation for comparison.
+
+    python bench_render.py [matches ...]
+'''
+WORDS_PER_MATCH = 20
+REPEAT = 3
+
+def synthetic_trial(matches):
+    # every element gets a tagged word every WORDS_PER_MATCH words, detailedDescription gets all matches
+    rnd = random.Random(matches)
+    untagged = {}
+    dicts = [{'name': name, 'raw': {}} for name in LINK_TEMPLATES]
+    for elem in TRIAL_ELEMENTS:
+        count = matches if elem == 'detailedDescription' else min(matches, 10)
+        words = []
+        pos = 0
+        for dr in dicts:
+            dr['raw'][elem] = []
+        for i in range(count * WORDS_PER_MATCH):
+            word = f'word{rnd.randint(0, 9999)}'
+            if i % WORDS_PER_MATCH == 0:
+                dr = dicts[rnd.randrange(len(dicts))]
+                ids = [[0, f'ID{rnd.randint(0, 99999)}'] for _ in range(rnd.randint(1, 3))]
+                dr['raw'][elem].append([pos, pos + len(word) - 1, ids])
+            words.append(word)
+            pos += len(word) + 1
+        untagged[elem] = ' '.join(words)
+    return {'untagged': untagged, 'dictionaries': dicts}
+
+def concat_tagged(doc, elem):
+    # the tagged text as it was built before, one concatenation at a time
+    original = doc['untagged'][elem]
+    links = {}
+    for dr in doc['dictionaries']:
+        for m in dr['raw'][elem]:
+            links.setdefault(m[1], []).extend(LINK_TEMPLATES[dr['name']](en[1]) for en in m[2])
+    lastTaken = -1
+    new_text = ''
+    for index in sorted(links):
+        new_text = new_text + original[lastTaken+1:index+1]
+        lastTaken = index
+        new_text = new_text + ' ('
+        cursor = 0
+        for url in links[index]:
+            if cursor == 0:
+                new_text = new_text + url
+            else:
+                new_text = new_text + ',' + url
+            cursor = cursor + 1
+        new_text = new_text + ')'
+    if lastTaken < len(original) - 1:
+        new_text = new_text + original[lastTaken+1:]
+    return new_text
+
+def concat_render(doc):
+    return {elem: concat_tagged(doc, elem) for elem in TRIAL_ELEMENTS}
+
+def best_time(func):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [100, 1000, 10000, 20000]
+    print (f"{'matches':>8} {'text size':>10} {'render':>9} {'concat':>9}")
+    for size in sizes:
+        doc = synthetic_trial(size)
+        render = lambda: render_tagged(doc['untagged'], doc['dictionaries'], TRIAL_ELEMENTS)
+        if render() != concat_render(doc):
+            print (f'Error: rendered text differs for {size} matches.')
+        t_new = best_time(render)
+        t_old = best_time(lambda: concat_render(doc))
+        text_size = len(doc['untagged']['detailedDescription'])
+        print (f'{size:>8} {text_size:>10} {t_new:8.4f}s {t_old:8.4f}s')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import sys
+import time
+import random
+
+from tag import new_dict_stats, generate_stats
+
+'''
+Times generate_stats on synthetic statistics of one dictionary for a growing
+number of identifiers, with the old list search of the top identifiers for
+comparison. Nothing is written to MongoDB.
+
+    python bench_stats.py [top_number ...]
+'''
+SIZES = [1000, 10000, 100000, 1000000]
+REPEAT = 3
+
+class NullCollection:
+    def update_one(self, *args, **kwargs):
+        pass
+
+def synthetic_stats(size):
+    stats_dict = new_dict_stats('protein')
+    rnd = random.Random(size)
+    for i in range(size):
+        identifier = f'P{i:06d}'
+        trials = rnd.randint(1, 50)
+        stats_dict['mentioned'][identifier] = trials
+        stats_dict['identifiers'][identifier] = trials * rnd.randint(1, 5)
+        stats_dict['words'][identifier.lower()] = trials
+        stats_dict['casefolded_words'].add(identifier.lower())
+    return {'protein': stats_dict}
+
+def list_search_top(stats_dict, top_number):
+    # the top identifiers as they were looked up before
+    identifiers_appeared = list(stats_dict['identifiers'].items())
+    top_ids = []
+    for identifier, trials in stats_dict['mentioned'].most_common(top_number):
+        search = [x for x in identifiers_appeared if x[0] == identifier]
+        top_ids.append( { identifier : {'trials': trials, 'tags': search[0][1]} })
+    return top_ids
+
+def best_time(func):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    top_numbers = [int(x) for x in sys.argv[1:]] or [200, 5000]
+    print (f"{'identifiers':>12} {'top':>6} {'generate_stats':>15} {'list search':>12}")
+    for size in SIZES:
+        stats = synthetic_stats(size)
+        for top_number in top_numbers:
+            t_new = best_time(lambda: generate_stats(stats, 1000, 100000, NullCollection(), top_number))
+            if size * top_number <= 10 ** 8:
+                t_old = f"{best_time(lambda: list_search_top(stats['protein'], top_number)):11.3f}s"
+            else:
+                t_old = f"{'skipped':>12}"
+            print (f'{size:>12} {top_number:>6} {t_new:14.3f}s {t_old}')
+
+if __name__ == "__main__":
+    main()
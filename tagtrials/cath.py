@@ -0,0 +1,73 @@
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from requests.adapters import HTTPAdapter
+from pymongo import UpdateOne
+
+'''
+Persistent cache of the CATH superfamilies of UniProt accessions, one document
+per accession in the cathid collection:
+    { 'accession' : 'P05231', 'superfamilies' : ['1.20.1250.10'], 'found' : True,
+      'timestamp' : datetime(2021, 3, 1) }
+A failed lookup is stored with found False and no superfamilies, it is
+fetched again after cath_negative_ttl hours instead of cath_ttl hours.
+Missing and expired accessions are fetched from the CATH REST API by
+cath_workers requests at a time.
+'''
+CATH_URL = 'http://www.cathdb.info/version/v4_3_0/api/rest/uniprot_to_funfam/'
+
+def new_cath_cache(cath_collection, url=CATH_URL, ttl=720, negative_ttl=24, workers=8, timeout=30.0):
+    cath_collection.create_index('accession', unique=True)
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+    return {'collection': cath_collection, 'url': url, 'ttl': timedelta(hours=ttl), \
+            'negative_ttl': timedelta(hours=negative_ttl), 'workers': max(workers, 1), \
+            'timeout': timeout, 'http': http, 'memory': {}}
+
+def is_fresh(entry, cache, now):
+    ttl = cache['ttl'] if entry['found'] else cache['negative_ttl']
+    return now - entry['timestamp'] < ttl
+
+def fetch_superfamilies(pacc, cache):
+    # returns the superfamilies of an accession in the order CATH lists them, None when the request fails
+    try:
+        response = cache['http'].get(cache['url'] + pacc, timeout=cache['timeout'])
+        if response.status_code != 200:
+            return None
+        sfids = {}
+        for rjd in response.json()['data']:
+            sfids.setdefault(rjd['superfamily_id'], True)
+        return list(sfids)
+    except (requests.RequestException, ValueError, KeyError, TypeError):
+        return None
+
+def fetch_entries(accessions, cache, now):
+    with ThreadPoolExecutor(max_workers=cache['workers']) as executor:
+        results = executor.map(lambda pacc: fetch_superfamilies(pacc, cache), accessions)
+        entries = {}
+        for pacc, sfids in zip(accessions, results):
+            entries[pacc] = {'accession': pacc, 'superfamilies': sfids or [], 'found': sfids is not None, \
+                            'timestamp': now}
+    return entries
+
+def get_superfamilies(accessions, cache):
+    # returns { accession: [superfamily id, ...] }, an accession without known superfamilies gets []
+    now = datetime.now()
+    memory = cache['memory']
+    wanted = [x for x in dict.fromkeys(accessions) if x not in memory or not is_fresh(memory[x], cache, now)]
+    if len(wanted) > 0:
+        for entry in cache['collection'].find({'accession': {'$in': wanted}}, projection={'_id': False}):
+            if is_fresh(entry, cache, now):
+                memory[entry['accession']] = entry
+        missing = [x for x in wanted if x not in memory or not is_fresh(memory[x], cache, now)]
+        if len(missing) > 0:
+            entries = fetch_entries(missing, cache, now)
+            cache['collection'].bulk_write([UpdateOne({'accession': pacc}, {'$set': entry}, upsert=True) \
+                                            for pacc, entry in entries.items()], ordered=False)
+            memory.update(entries)
+            failed = sum(1 for x in entries.values() if not x['found'])
+            print (f'.. CATH superfamilies fetched for {len(missing)} accessions, {failed} failed.')
+    return {x: memory[x]['superfamilies'] for x in accessions}
@@ -0,0 +1,70 @@
+import csv
+
+'''
+Preferred names of the identifiers of a dictionary, the first word of every
+dictionary entry:
+    { 'P05231' : 'IL6', 'Q9BYF1' : 'ACE2' }
+read from the dictionary collections or from a csv file with a header line
+and the identifier and preferred name columns, like PreferredProteinName.csv
+and chembl_preferred.csv in analysis/. Loaded once, then every lookup is a
+dict access.
+'''
+PROTEIN_CSV = 'PreferredProteinName.csv'
+CHEMBL_CSV = 'chembl_preferred.csv'
+# dictionary collections with { 'key' : 'CHEMBL25', 'words' : ['ASPIRIN', ...] } documents
+DICTIONARY_COLLECTIONS = {'chembl': 'chembl_dict', 'pdb': 'pdb_dict'}
+PROTEIN_COLLECTION = 'entitydictionary'
+# pubchem has no dictionary collection, its names are the latest whitelist
+# { 'dictionary' : [ { 'cid' : '2244', 'words' : ['aspirin'] } ], 'timestamp' : datetime }
+PUBCHEM_WHITELIST = 'pubchem_whitelist'
+
+def protein_names(collection):
+    # entitydictionary documents hold the entries in their dictionary array
+    names = {}
+    projection = {'_id': False, 'dictionary.primary_accession': True, 'dictionary.words': True}
+    for edict in collection.find(projection=projection):
+        for entry in edict.get('dictionary', None) or []:
+            if entry.get('words', None):
+                names.setdefault(entry['primary_accession'], entry['words'][0])
+    return names
+
+def dictionary_names(collection):
+    names = {}
+    for entry in collection.find(projection={'_id': False, 'key': True, 'words': {'$slice': 1}}):
+        if entry.get('words', None):
+            names.setdefault(entry['key'], entry['words'][0])
+    return names
+
+def whitelist_names(collection, key_field='cid', words_field='words'):
+    names = {}
+    whitelist = collection.find_one(sort=[('timestamp', -1)])
+    for grp in (whitelist or {}).get('dictionary', None) or []:
+        if grp.get(words_field, None):
+            names.setdefault(grp[key_field], grp[words_field][0])
+    return names
+
+def csv_names(path):
+    names = {}
+    with open(path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None)
+        for row in reader:
+            if len(row) >= 2:
+                names.setdefault(row[0], row[1])
+    return names
+
+def load_preferred_names(db, dictionaries=('protein', 'chembl', 'pdb', 'pubchem')):
+    # returns { dictionary name: { identifier: preferred name } }
+    preferred = {}
+    for name in dictionaries:
+        if name == 'protein':
+            preferred[name] = protein_names(db[PROTEIN_COLLECTION])
+        elif name == 'pubchem':
+            preferred[name] = whitelist_names(db[PUBCHEM_WHITELIST])
+        elif name in DICTIONARY_COLLECTIONS:
+            preferred[name] = dictionary_names(db[DICTIONARY_COLLECTIONS[name]])
+        print (f'.. {len(preferred.get(name, {}))} preferred names of dictionary {name}')
+    return preferred
+
+def get_preferred(preferred, name, key):
+    return preferred.get(name, {}).get(key, None)
@@ -0,0 +1,52 @@
+'''
+Columnar encoding of the raw matches of a dictionary entry of a trial. The
+matches as returned by the tag service,
+    'raw' : { 'briefTitle' : [ [0, 3, [[9606, 'P05231']]],
+                               [10, 13, [[9606, 'P05231'], [9606, 'Q9BYF1']]] ] }
+are stored with every entity once in the entities table of the entry:
+    'entities' : [ [9606, 'P05231'], [9606, 'Q9BYF1'] ],
+    'raw' : { 'briefTitle' : { 's' : [0, 10], 'e' : [3, 13], 'n' : [1, 3], 'x' : [0, 0, 1] } }
+s and e are the start and end of the matches, x the entity indexes of all
+matches and n the end of the indexes of every match in x. The arrays stay
+plain BSON integer arrays so the aggregation pipelines can read them.
+'''
+RAW_JSON = 'json'
+RAW_COLUMNAR = 'columnar'
+
+def encode_raw(raw):
+    # returns the entities table and the encoded matches of every element
+    entities = []
+    positions = {}
+    encoded = {}
+    for elem, matches in raw.items():
+        columns = {'s': [], 'e': [], 'n': [], 'x': []}
+        for m in matches:
+            columns['s'].append(m[0])
+            columns['e'].append(m[1])
+            for en in m[2]:
+                key = (en[0], en[1])
+                pos = positions.get(key, None)
+                if pos is None:
+                    pos = len(entities)
+                    positions[key] = pos
+                    entities.append([en[0], en[1]])
+                columns['x'].append(pos)
+            columns['n'].append(len(columns['x']))
+        encoded[elem] = columns
+    return entities, encoded
+
+def decode_matches(entry, elem):
+    # the matches of one element as [start, end, [[type, id], ...]], for both encodings
+    raw = entry['raw'].get(elem, None)
+    if not raw:
+        return []
+    if 'entities' not in entry:
+        return raw
+    entities = entry['entities']
+    x = raw['x']
+    matches = []
+    first = 0
+    for start, end, last in zip(raw['s'], raw['e'], raw['n']):
+        matches.append([start, end, [entities[i] for i in x[first:last]]])
+        first = last
+    return matches
@@ -0,0 +1,63 @@
+from flask import Flask
+from flask import jsonify
+
+from functools import lru_cache
+
+from tag import read_config, get_db, CONFIG_SECTION, TRIAL_ELEMENTS
+from render import render_tagged
+
+'''
+Read api for the tagged text of trials. With store_tagged = false the
+tagged text is not saved by tag.py, it is rendered here from the untagged
+text and the raw matches. Rendered trials are kept in a LRU cache keyed by
+the ctid, the trial timestamp and the timestamps and element hashes of the
+dictionaries the trial is tagged with, so a partial retag of a changed text
+is rendered again.
+
+    GET /trials/<ctid>/tagged
+    { 'ctid': 'NCT04280705', 'tagged': { 'briefTitle': '...', ... } }
+'''
+STAMP_PROJECTION = {'_id': False, 'ctid': True, 'timestamp': True, 'dictionaries.name': True, \
+                    'dictionaries.blacklist_timestamp': True, 'dictionaries.whitelist_timestamp': True, \
+                    'dictionaries.hashes': True}
+RENDER_PROJECTION = {'_id': False, 'dictionaries.name': True, 'dictionaries.raw': True, \
+                    'dictionaries.entities': True}
+RENDER_PROJECTION.update({'untagged.' + elem: True for elem in TRIAL_ELEMENTS})
+
+app = Flask(__name__)
+
+config = read_config()
+db = get_db(config)
+trial_collection = db[config.get(CONFIG_SECTION, 'mongodb_trialcollection')]
+trial_collection.create_index('ctid')
+cache_size = config.getint(CONFIG_SECTION, 'read_api_cache_size', fallback=1024)
+print (f'.. rendered trial cache size: {cache_size}')
+
+def get_stamps(doc):
+    return (doc.get('timestamp', None),) + tuple((d['name'], d['blacklist_timestamp'], d['whitelist_timestamp'], \
+                    tuple(sorted((d.get('hashes', None) or {}).items()))) for d in doc.get('dictionaries', None) or [])
+
+def render_trial(ctid, stamps):
+    # stamps are only part of the cache key, a retagged trial is rendered again
+    doc = trial_collection.find_one({'ctid': ctid}, projection=RENDER_PROJECTION)
+    if doc is None:
+        return None
+    return render_tagged(doc['untagged'], doc.get('dictionaries', None), TRIAL_ELEMENTS)
+
+render_cached = lru_cache(maxsize=max(cache_size, 0))(render_trial)
+
+@app.route('/trials/<ctid>/tagged', methods=['GET'])
+def get_tagged(ctid):
+    doc = trial_collection.find_one({'ctid': ctid}, projection=STAMP_PROJECTION)
+    tagged = render_cached(ctid, get_stamps(doc)) if doc else None
+    if tagged is None:
+        return jsonify({'error': 'trial ' + ctid + ' not found.'}), 404
+    return jsonify({'ctid': ctid, 'tagged': tagged})
+
+@app.route('/cache', methods=['GET'])
+def get_cache():
+    info = render_cached.cache_info()
+    return jsonify({'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'max_size': info.maxsize})
+
+if __name__ == "__main__":
+    app.run(host='0.0.0.0', port=config.getint(CONFIG_SECTION, 'read_api_port', fallback=5001))
@@ -0,0 +1,44 @@
+from rawcodec import decode_matches
+
+'''
+Renders the tagged text of a trial: after the last character of every
+tagged word the links of its identifiers are inserted,
+    'IL-6 (<a href="https://aquaria.ws/P05231">Aquaria</a>) level'
+'''
+LINK_TEMPLATES = {
+    'protein': '<a href="https://aquaria.ws/{}">Aquaria</a>'.format,
+    'pdb': '<a href="https://www.rcsb.org/ligand/{}">PDB</a>'.format,
+    'chembl': '<a href="https://www.ebi.ac.uk/chembl/compound_report_card/{}/">ChEMBL</a>'.format,
+    'pubchem': '<a href="https://pubchem.ncbi.nlm.nih.gov/compound/{}">PubChem</a>'.format,
+}
+
+def add_links(links, name, raw):
+    # links of every match by the position of its last character
+    template = LINK_TEMPLATES.get(name, None)
+    for m in raw:
+        urls = links.setdefault(m[1], [])
+        if template:
+            urls.extend(template(en[1]) for en in m[2])
+
+def render_text(original, links):
+    if len(links) == 0:
+        return original
+    parts = []
+    last = 0
+    for index in sorted(links):
+        parts.append(original[last:index+1])
+        parts.append(' (')
+        parts.append(','.join(links[index]))
+        parts.append(')')
+        last = index + 1
+    parts.append(original[last:])
+    return ''.join(parts)
+
+def render_tagged(untagged, dict_raws, elements):
+    # returns the tagged text of every element, dict_raws are the dictionary entries of the trial
+    links = {elem: {} for elem in elements}
+    for dr in dict_raws or []:
+        name = dr['name']
+        for elem in elements:
+            add_links(links[elem], name, decode_matches(dr, elem))
+    return {elem: render_text(untagged[elem], links[elem]) for elem in elements}
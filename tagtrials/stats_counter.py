@@ -0,0 +1,130 @@
+from collections import Counter
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne, InsertOne
+
+'''
+Persistent statistics counters, one document per tagged word and identifier
+of every dictionary, kept up to date while trials are retagged:
+    { 'name' : 'protein', 'kind' : 'word', 'key' : 'IL-6', 'n' : 12 }
+    { 'name' : 'protein', 'kind' : 'identifier', 'key' : 'P05231', 'n' : 12, 'trials' : 2 }
+and one document with the total word count and the time of the last rebuild:
+    { 'name' : '*', 'kind' : 'total', 'key' : 'words', 'n' : 4320, 'rebuilt' : datetime }
+'''
+KIND_WORD = 'word'
+KIND_IDENTIFIER = 'identifier'
+KIND_TOTAL = 'total'
+TOTAL_FILTER = {'name': '*', 'kind': KIND_TOTAL, 'key': 'words'}
+WRITE_SIZE = 1000
+
+def create_counter_indexes(counter_collection):
+    counter_collection.create_index([('name', 1), ('kind', 1), ('key', 1)], unique=True)
+
+def has_counters(counter_collection):
+    return counter_collection.find_one(TOTAL_FILTER) is not None
+
+def is_rebuild_due(counter_collection, interval):
+    # a missing total document means the counters were never built or a rebuild was interrupted
+    total = counter_collection.find_one(TOTAL_FILTER)
+    if total is None:
+        return True
+    return interval > 0 and total['rebuilt'] + timedelta(hours=interval) <= datetime.now()
+
+def invalidate_counters(counter_collection):
+    # without the total document the next statistics update rebuilds the counters
+    counter_collection.delete_one(TOTAL_FILTER)
+
+def new_delta():
+    return {'words': 0, 'dicts': {}}
+
+def get_dict_delta(delta, name):
+    d = delta['dicts'].get(name, None)
+    if d is None:
+        d = {'words': Counter(), 'identifiers': Counter(), 'trials': Counter()}
+        delta['dicts'][name] = d
+    return d
+
+def add_trial_delta(delta, old, new):
+    # old and new are (running statistics, word count) of one trial before and after retagging
+    old_stats, old_words = old
+    new_stats, new_words = new
+    delta['words'] += new_words - old_words
+    for name in set(old_stats) | set(new_stats):
+        d = get_dict_delta(delta, name)
+        old_dict = old_stats.get(name, None)
+        new_dict = new_stats.get(name, None)
+        old_mentioned = set(old_dict['mentioned']) if old_dict else set()
+        new_mentioned = set(new_dict['mentioned']) if new_dict else set()
+        if new_dict:
+            d['words'].update(new_dict['words'])
+            d['identifiers'].update(new_dict['identifiers'])
+        if old_dict:
+            d['words'].subtract(old_dict['words'])
+            d['identifiers'].subtract(old_dict['identifiers'])
+        d['trials'].update(new_mentioned - old_mentioned)
+        d['trials'].subtract(old_mentioned - new_mentioned)
+
+def counter_updates(delta):
+    updates = []
+    for name, d in delta['dicts'].items():
+        for word, n in d['words'].items():
+            if n != 0:
+                updates.append(UpdateOne({'name': name, 'kind': KIND_WORD, 'key': word}, \
+                                {'$inc': {'n': n}}, upsert=True))
+        for identifier in set(d['identifiers']) | set(d['trials']):
+            n = d['identifiers'][identifier]
+            trials = d['trials'][identifier]
+            if n == 0 and trials == 0:
+                continue
+            updates.append(UpdateOne({'name': name, 'kind': KIND_IDENTIFIER, 'key': identifier}, \
+                            {'$inc': {'n': n, 'trials': trials}}, upsert=True))
+    if delta['words'] != 0:
+        # never upserted, the total is only created by a full rebuild
+        updates.append(UpdateOne(TOTAL_FILTER, {'$inc': {'n': delta['words']}}, upsert=False))
+    return updates
+
+def apply_delta(counter_collection, delta):
+    updates = counter_updates(delta)
+    for i in range(0, len(updates), WRITE_SIZE):
+        counter_collection.bulk_write(updates[i:i+WRITE_SIZE], ordered=False)
+    return len(updates)
+
+def rebuild_counters(counter_collection, stats, total_words):
+    # the total document is removed first and written last, an interrupted
+    # rebuild is started again by the next statistics update.
+    counter_collection.delete_one(TOTAL_FILTER)
+    counter_collection.delete_many({})
+    inserts = []
+    for name, stats_dict in stats.items():
+        for word, n in stats_dict['words'].items():
+            inserts.append(InsertOne({'name': name, 'kind': KIND_WORD, 'key': word, 'n': n}))
+        for identifier, n in stats_dict['identifiers'].items():
+            inserts.append(InsertOne({'name': name, 'kind': KIND_IDENTIFIER, 'key': identifier, \
+                            'n': n, 'trials': stats_dict['mentioned'][identifier]}))
+    for i in range(0, len(inserts), WRITE_SIZE):
+        counter_collection.bulk_write(inserts[i:i+WRITE_SIZE], ordered=False)
+    counter_collection.insert_one(dict(TOTAL_FILTER, n=total_words, rebuilt=datetime.now()))
+
+def read_counters(counter_collection, new_stats):
+    # returns the running statistics and total word count stored in the counters
+    counter_collection.delete_many({'kind': {'$ne': KIND_TOTAL}, 'n': {'$lte': 0}})
+    stats = {}
+    total_words = 0
+    for doc in counter_collection.find():
+        name = doc['name']
+        if doc['kind'] == KIND_TOTAL:
+            total_words = doc['n']
+            continue
+        stats_dict = stats.get(name, None)
+        if stats_dict is None:
+            stats_dict = new_stats(name)
+            stats[name] = stats_dict
+        key = doc['key']
+        if doc['kind'] == KIND_WORD:
+            stats_dict['words'][key] = doc['n']
+            stats_dict['casefolded_words'].add(key.casefold())
+        else:
+            stats_dict['identifiers'][key] = doc['n']
+            if doc['trials'] > 0:
+                stats_dict['mentioned'][key] = doc['trials']
+    return stats, total_words
@@ -0,0 +1,83 @@
+'''
+Server side statistics: the trial text is read by MongoDB aggregation
+pipelines, only grouped counts are sent back.
+
+words pipeline, one document per distinct tagged word of a dictionary:
+    { '_id' : 'IL-6', 'n' : 12 }
+identifiers pipeline, one document per identifier of a dictionary:
+    { '_id' : 'P05231', 'tags' : 12, 'trials' : 2 }
+'''
+
+# \S+ counts the same words as str.split() for ascii whitespace
+WORD_REGEX = r'\S+'
+
+def element_text(elem):
+    return {'$ifNull': ['$untagged.' + elem, '']}
+
+def element_word_count(elem):
+    return {'$size': {'$regexFindAll': {'input': element_text(elem), 'regex': WORD_REGEX}}}
+
+def match_tag(text, start, end, ids):
+    # a match -> {'word': text[start:end+1], 'ids': [id, ...]}
+    return {'word': {'$substrCP': [text, start, {'$add': [{'$subtract': [end, start]}, 1]}]}, 'ids': ids}
+
+def entity_ids(entities):
+    return {'$map': {'input': entities, 'as': 'e', 'in': {'$arrayElemAt': ['$$e', 1]}}}
+
+def json_tags(elem):
+    # raw matches [start, end, [[type, id], ...]]
+    return {'$map': {'input': '$$raw', 'as': 'm', 'in': match_tag(element_text(elem), \
+                {'$arrayElemAt': ['$$m', 0]}, {'$arrayElemAt': ['$$m', 1]}, \
+                entity_ids({'$arrayElemAt': ['$$m', 2]}))}}
+
+def columnar_tags(elem):
+    # columnar matches, see rawcodec, zipped to [start, end, first index in x, end index in x]
+    bounds = {'$zip': {'inputs': ['$$raw.s', '$$raw.e', {'$concatArrays': [[0], '$$raw.n']}, '$$raw.n']}}
+    first = {'$arrayElemAt': ['$$m', 2]}
+    count = {'$subtract': [{'$arrayElemAt': ['$$m', 3]}, first]}
+    # $slice needs a positive count
+    indexes = {'$cond': [{'$gt': [count, 0]}, {'$slice': ['$$raw.x', first, count]}, []]}
+    entities = {'$map': {'input': indexes, 'as': 'k', 'in': {'$arrayElemAt': ['$dictionaries.entities', '$$k']}}}
+    return {'$map': {'input': bounds, 'as': 'm', 'in': match_tag(element_text(elem), \
+                {'$arrayElemAt': ['$$m', 0]}, {'$arrayElemAt': ['$$m', 1]}, entity_ids(entities))}}
+
+def element_tags(elem):
+    return {'$let': {'vars': {'raw': {'$ifNull': ['$dictionaries.raw.' + elem, []]}}, \
+                'in': {'$cond': [{'$isArray': '$$raw'}, json_tags(elem), columnar_tags(elem)]}}}
+
+def tags_pipeline(name, elements):
+    projection = {'dictionaries': {'$filter': {'input': '$dictionaries', \
+                    'cond': {'$eq': ['$$this.name', name]}}}}
+    projection.update({'untagged.' + elem: True for elem in elements})
+    return [{'$match': {'dictionaries.name': name}},
+            {'$project': projection},
+            {'$unwind': '$dictionaries'},
+            {'$project': {'tags': {'$concatArrays': [element_tags(elem) for elem in elements]}}},
+            {'$unwind': '$tags'}]
+
+def aggregate_totals(trial_collection, elements):
+    # returns the number of trials and their words, counted once for every dictionary of a trial
+    pipeline = [{'$project': {'n': {'$size': {'$ifNull': ['$dictionaries', []]}}, \
+                            'words': {'$add': [element_word_count(elem) for elem in elements]}}},
+                {'$group': {'_id': None, 'trials': {'$sum': 1}, 'words': {'$sum': {'$multiply': ['$n', '$words']}}}}]
+    for doc in trial_collection.aggregate(pipeline, allowDiskUse=True):
+        return doc['trials'], doc['words']
+    return 0, 0
+
+def aggregate_dictionary(trial_collection, name, elements, stats_dict):
+    # fills the running statistics of one dictionary
+    words = tags_pipeline(name, elements) + [
+                {'$group': {'_id': '$tags.word', 'n': {'$sum': 1}}},
+                {'$sort': {'n': -1, '_id': 1}}]
+    for doc in trial_collection.aggregate(words, allowDiskUse=True):
+        stats_dict['words'][doc['_id']] = doc['n']
+        stats_dict['casefolded_words'].add(doc['_id'].casefold())
+    identifiers = tags_pipeline(name, elements) + [
+                {'$unwind': '$tags.ids'},
+                {'$group': {'_id': {'id': '$tags.ids', 'trial': '$_id'}, 'tags': {'$sum': 1}}},
+                {'$group': {'_id': '$_id.id', 'tags': {'$sum': '$tags'}, 'trials': {'$sum': 1}}},
+                {'$sort': {'_id': 1}}]
+    for doc in trial_collection.aggregate(identifiers, allowDiskUse=True):
+        identifier = doc['_id']
+        stats_dict['identifiers'][identifier] = doc['tags']
+        stats_dict['mentioned'][identifier] = doc['trials']
@@ -3,23 +3,49 @@ import time
 import configparser
 import requests
 import json
+import gzip
+import hashlib
+import re
 import sys
+import threading
 import traceback
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from itertools import chain
+from itertools import islice
+from urllib.parse import urlencode
 
-from pymongo import MongoClient
+from requests.adapters import HTTPAdapter
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from bson.objectid import ObjectId
 
 from visual import generate_visual_data 
+from cath import new_cath_cache, CATH_URL
+from preferred import load_preferred_names
+from render import render_tagged
+from rawcodec import encode_raw, decode_matches, RAW_JSON, RAW_COLUMNAR
+from stats_pipeline import aggregate_totals, aggregate_dictionary
+from stats_counter import create_counter_indexes, has_counters, is_rebuild_due, new_delta, \
+        add_trial_delta, apply_delta, rebuild_counters, read_counters, invalidate_counters
+from trialindex import create_trial_index_indexes, is_trial_index_built, build_trial_index, \
+        trial_identifiers, new_index_delta, add_trial_index_delta, apply_index_delta
 
 CONFIG_SECTION = 'App'
 STAT_COLLECTION = 'stat'
+COUNTER_COLLECTION = 'statcounter'
+TRIAL_INDEX_COLLECTION = 'trialindex'
 TOP_NUMBER = 200
 TRIAL_ELEMENTS = ['briefTitle', 'studyDesign', 'briefSummary', 'officialTitle', 'detailedDescription']
 
 TOTAL_IDENTIFIERS = 'total_tags'
+SELECT_FULL = 'full'
+SELECT_INCREMENTAL = 'incremental'
+STATS_PYTHON = 'python'
+STATS_MONGODB = 'mongodb'
+STATS_INCREMENTAL = 'incremental'
+NAMES_PER_REGEX = 200
+KEY_FIELDS = {'protein': 'primary_accession', 'pdb': 'pdb_key', 'chembl': 'chembl_key', 'pubchem': 'pubchem_cid'}
 
 def main():
     # read configuration
@@ -28,21 +54,68 @@ def main():
     t_c_name = config.get(CONFIG_SECTION, 'mongodb_trialcollection')
     tag_service_url = config.get(CONFIG_SECTION, 'tag_service')
     print (f'.. tag service url: {tag_service_url}')
+    http = get_http_session(config)
     tag_interval = config.getint(CONFIG_SECTION, 'tag_interval')
+    trial_selection = config.get(CONFIG_SECTION, 'trial_selection', fallback=SELECT_FULL)
+    print (f'.. trial selection: {trial_selection}')
+    bulk_write_size = config.getint(CONFIG_SECTION, 'bulk_write_size', fallback=500)
+    bulk_write_ordered = config.getboolean(CONFIG_SECTION, 'bulk_write_ordered', fallback=False)
+    store_tagged = config.getboolean(CONFIG_SECTION, 'store_tagged', fallback=True)
+    raw_encoding = config.get(CONFIG_SECTION, 'raw_encoding', fallback=RAW_JSON)
+    print (f'.. raw match encoding: {raw_encoding}')
+    tag_workers = config.getint(CONFIG_SECTION, 'tag_workers', fallback=1)
+    print (f'.. tagging workers: {tag_workers}')
+    tag_retries = config.getint(CONFIG_SECTION, 'tag_retries', fallback=3)
+    tag_retry_backoff = config.getfloat(CONFIG_SECTION, 'tag_retry_backoff', fallback=1.0)
+    reload_wait = config.getint(CONFIG_SECTION, 'reload_wait', fallback=600)
+    delta_retag = config.getboolean(CONFIG_SECTION, 'delta_retag', fallback=False)
+    stats_backend = config.get(CONFIG_SECTION, 'stats_backend', fallback=STATS_PYTHON)
+    print (f'.. statistics backend: {stats_backend}')
+    stats_rebuild_interval = config.getint(CONFIG_SECTION, 'stats_rebuild_interval', fallback=24)
+    top_number = config.getint(CONFIG_SECTION, 'top_number', fallback=TOP_NUMBER)
     # get all the collection
     trial_collection = db[t_c_name]
+    if trial_selection == SELECT_INCREMENTAL:
+        create_trial_indexes(trial_collection)
     stat_collection = db[STAT_COLLECTION]
-    cath_collection = db['cathid']
-    cluster_collection = db['keycluster']
+    counter_collection = db[COUNTER_COLLECTION]
+    if stats_backend == STATS_INCREMENTAL:
+        create_counter_indexes(counter_collection)
+    trial_index_collection = db[TRIAL_INDEX_COLLECTION]
+    create_trial_index_indexes(trial_index_collection)
+    cath = new_cath_cache(db['cathid'], config.get(CONFIG_SECTION, 'cath_url', fallback=CATH_URL), \
+                config.getfloat(CONFIG_SECTION, 'cath_ttl', fallback=720), \
+                config.getfloat(CONFIG_SECTION, 'cath_negative_ttl', fallback=24), \
+                config.getint(CONFIG_SECTION, 'cath_workers', fallback=8), \
+                config.getfloat(CONFIG_SECTION, 'cath_timeout', fallback=30.0))
+    cluster_collection = db[config.get(CONFIG_SECTION, 'cluster_collection', fallback='chemical_cluster')]
     visualfile_collection = db['visualfile']
-    # load protein dictionaries
-    protein_dict = db['entitydictionary'].find_one()['dictionary']
-    cath_cluster = {'name':'protein' 'dict': cath_dict, 'timestamp': datetime.now()}
-    cath_dict = {}
-    
-    context = {'protein_dict': protein_dict, 'cath_dict': cath_dict, \
+    # preferred names of the dictionary identifiers
+    preferred = load_preferred_names(db)
+
+    context = {'preferred': preferred, 'cath': cath, \
                 'stat_collection': stat_collection, \
-                'visualfile_collection': visualfile_collection }
+                'visualfile_collection': visualfile_collection, \
+                'cluster_collection': cluster_collection, \
+                'trial_selection': trial_selection, \
+                'bulk_write_size': max(bulk_write_size, 1), \
+                'bulk_write_ordered': bulk_write_ordered, \
+                'store_tagged': store_tagged, \
+                'raw_encoding': raw_encoding, \
+                'tag_workers': max(tag_workers, 1), \
+                'tag_retries': max(tag_retries, 0), \
+                'tag_retry_backoff': tag_retry_backoff, \
+                'reload_wait': reload_wait, \
+                'delta_retag': delta_retag, \
+                'stats_backend': stats_backend, \
+                'counter_collection': counter_collection, \
+                'trial_index_collection': trial_index_collection, \
+                'stats_rebuild_interval': stats_rebuild_interval, \
+                'top_number': max(top_number, 0), \
+                'http': http, \
+                'http_timeout': (config.getfloat(CONFIG_SECTION, 'http_connect_timeout', fallback=5.0), \
+                                config.getfloat(CONFIG_SECTION, 'http_read_timeout', fallback=120.0)), \
+                'http_gzip_min_size': config.getint(CONFIG_SECTION, 'http_gzip_min_size', fallback=1024) }
 
     if tag_interval <= 0 :
         tag_interval = 5
@@ -56,154 +129,438 @@ def main():
         schedule.run_pending()
         time.sleep(1)
 
-def tag_element(doc, doc_elem, url, name, keys):
-    text = doc['untagged'][doc_elem]
-    r = requests.post(url, json= {'doc':text, 'dict' : name})
-    jr = json.loads(r.text)
-    match = jr['match']
-    for m in match:
-        for en in m[2]:
-            prim = en[1]
-            if prim not in keys:
-                keys.append(prim)
-    return match
-
-def tag_doc_dict(doc, tservice, ts_url):
+def new_counters():
+    return {'lock': threading.Lock(), 'start': time.time(), 'trials': 0, 'retagged': 0, \
+            'saved': 0, 'failed': 0, 'requests': 0, 'retries': 0, 'bumped': 0}
+
+def count(counters, key, n=1):
+    with counters['lock']:
+        counters[key] += n
+
+def print_counters(counters):
+    elapsed = time.time() - counters['start']
+    rate = counters['trials'] / elapsed if elapsed > 0 else 0.0
+    print (f"{counters['trials']} trials checked, {counters['retagged']} retagged, " \
+        f"{counters['saved']} saved, {counters['failed']} failed, {counters['requests']} requests " \
+        f"({counters['retries']} retries) in {elapsed:.1f}s, {rate:.1f} trials/s, " \
+        f"{counters['bumped']} trials only got new list versions.")
+
+def post_json(url, payload, context):
+    body = json.dumps(payload).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    min_size = context['http_gzip_min_size']
+    if min_size >= 0 and len(body) >= min_size:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    return send_json('POST', url, context, data=body, headers=headers)
+
+def get_json(url, context):
+    return send_json('GET', url, context)
+
+def send_json(method, url, context, **kwargs):
+    # connection errors and server errors are retried with exponential backoff.
+    counters = context['counters']
+    attempt = 0
+    while True:
+        count(counters, 'requests')
+        try:
+            r = context['http'].request(method, url, timeout=context['http_timeout'], **kwargs)
+            if r.status_code < 500:
+                break
+            error = f'HTTP {r.status_code}'
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        if attempt >= context['tag_retries']:
+            raise IOError(f'request to {url} failed: {error}')
+        count(counters, 'retries')
+        time.sleep(context['tag_retry_backoff'] * (2 ** attempt))
+        attempt += 1
+    r.raise_for_status()
+    return json.loads(r.text)
+
+def tag_elements(doc, url, retag, context):
+    # one request tags the trial elements, retag maps a dictionary name to the elements it tags
+    names = list(retag)
+    docs = []
+    for elem in TRIAL_ELEMENTS:
+        elem_names = [x for x in names if elem in retag[x]]
+        if len(elem_names) > 0:
+            docs.append({'id': elem, 'text': doc['untagged'][elem], 'dicts': elem_names})
+    jr = post_json(url, {'docs': docs, 'dicts': names}, context)
+    if 'error' in jr:
+        raise ValueError(jr['error'])
+    # the dictionary versions actually used, a dictionary may be reloaded in between
+    return jr['match'], {x['name']: x for x in parse_tagservices(jr['dictionaries'])}
+
+def get_dict_entry(doc, name):
+    exist = [x for x in doc.get('dictionaries', None) or [] if x['name'] == name]
+    if len(exist)>0:
+        return exist[0]
+    return None
+
+def is_dict_outdated(doc, tservice):
+    found = get_dict_entry(doc, tservice['name'])
+    if found and found['blacklist_timestamp'] >= tservice['blacklist_timestamp'] and found['whitelist_timestamp'] >= tservice['whitelist_timestamp']:
+        return False # there is no need to retag.
+    return True
+
+def is_same_version(entry, tservice):
+    return entry['blacklist_timestamp'] == tservice['blacklist_timestamp'] \
+        and entry['whitelist_timestamp'] == tservice['whitelist_timestamp']
+
+def text_hash(text):
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()
+
+def get_retag_elements(doc, tservice, hashes):
+    # every element with an outdated dictionary, otherwise the elements whose text
+    # changed since they were tagged (trials tagged without hashes are kept).
+    if is_dict_outdated(doc, tservice):
+        return list(TRIAL_ELEMENTS)
+    tagged_hashes = get_dict_entry(doc, tservice['name']).get('hashes', None) or {}
+    return [x for x in TRIAL_ELEMENTS if x in tagged_hashes and tagged_hashes[x] != hashes[x]]
+
+def tag_doc_dict(doc, tservice, matches, elements, hashes, encoding=RAW_JSON):
+    # the matches of elements are replaced, the other elements keep theirs
     if not doc.get('dictionaries', None):
         doc['dictionaries'] = []
     name = tservice['name']
-    found = None
-    exist = [x for x in doc['dictionaries'] if x['name'] == name]
-    if len(exist)>0:
-        found = exist[0]
-        if found['blacklist_timestamp'] >= tservice['blacklist_timestamp'] and found['whitelist_timestamp'] >= tservice['whitelist_timestamp']:
-            return False # there is no need to retag.
+    found = get_dict_entry(doc, name)
     raw = {}
     keys = []
-    raw['studyDesign'] = tag_element(doc, 'studyDesign', ts_url, name, keys)
-    raw['briefSummary'] = tag_element(doc, 'briefSummary', ts_url, name, keys)
-    raw['briefTitle'] = tag_element(doc, 'briefTitle', ts_url, name, keys)
-    raw['officialTitle'] = tag_element(doc, 'officialTitle', ts_url, name, keys)
-    raw['detailedDescription'] = tag_element(doc, 'detailedDescription', ts_url, name, keys)
-    #raw['publications'] = tag_element(doc, 'publications', ts_url, name, keys)
-    if found:
-        found['raw'] = raw
-        found['name'] = name
-        found['blacklist_timestamp'] = tservice['blacklist_timestamp']
-        found['whitelist_timestamp'] = tservice['whitelist_timestamp']
+    for elem in TRIAL_ELEMENTS:
+        if elem in elements:
+            match = matches[elem][name]
+        else:
+            match = decode_matches(found, elem)
+        for m in match:
+            for en in m[2]:
+                prim = en[1]
+                if prim not in keys:
+                    keys.append(prim)
+        raw[elem] = match
+    if not found:
+        found = {}
+        doc['dictionaries'].append(found)
+    if encoding == RAW_COLUMNAR:
+        found['entities'], raw = encode_raw(raw)
     else:
-        doc['dictionaries'].append( {'raw': raw, 'name': name , \
-            'blacklist_timestamp': tservice['blacklist_timestamp'], \
-            'whitelist_timestamp' : tservice['whitelist_timestamp'] } )
-    if name == 'protein':
-        doc['primary_accession'] = keys
-    elif name == 'pdb':
-        doc['pdb_key'] = keys
-    elif name == 'chembl':
-        doc['chembl_key'] = keys
-    elif name == 'pubchem':
-        doc['pubchem_cid'] = keys
-    return True
-
-def create_key_link(name, keys):
-    links = []
-    if name == 'protein':
-        for k in keys:
-            url =  '<a href=\"https://aquaria.ws/' +  k + '\">Aquaria</a>' 
-            links.append(url)
-    elif name == 'pdb':
-        for k in keys:
-            url =  '<a href=\"https://www.rcsb.org/ligand/' +  k + '\">PDB</a>' 
-            links.append(url)
-    elif name == 'chembl':
-        for k in keys:
-            url =  '<a href=\"https://www.ebi.ac.uk/chembl/compound_report_card/' +  k + '/\">ChEMBL</a>' 
-            links.append(url)
-    elif name == 'pubchem':
-        for k in keys:
-            url =  '<a href=\"https://pubchem.ncbi.nlm.nih.gov/compound/' +  k + '\">PubChem</a>' 
-            links.append(url)
-    return links 
-
-def create_links(links, name, raw):
-    for m in raw:
-        index = m[1]
-        keys = []
-        for en in m[2]:
-            keys.append(en[1])
-        k_links = create_key_link(name, keys)
-        if index not in links.keys():
-            links[index] = []
-        links[index].extend(k_links) 
-
-def tagged_item(doc, elem):
-    original = doc['untagged'][elem]
-    dict_raws = doc.get('dictionaries', None)
-    links = {}
-    if dict_raws:
-        for dr in dict_raws:
-            name = dr['name']
-            raw = dr['raw'][elem]
-            create_links(links, name, raw)
-    lastTaken = -1 
-    new_text = ''
-    if len(links.keys()) == 0:
-        return original 
-    for index in sorted (links) :
-        urls = links[index]
-        new_text = new_text + original[lastTaken+1:index+1]
-        lastTaken = index
-        new_text = new_text + ' ('
-        cursor = 0
-        for url in urls:
-            if cursor == 0:
-                new_text = new_text + url
-            else:
-                new_text = new_text + ',' + url
-            cursor = cursor + 1
-        new_text = new_text + ')'
-    if lastTaken < len(original) - 1:
-        new_text = new_text + original[lastTaken+1:]
-    return new_text
+        found.pop('entities', None)
+    found['raw'] = raw
+    found['name'] = name
+    found['blacklist_timestamp'] = tservice['blacklist_timestamp']
+    found['whitelist_timestamp'] = tservice['whitelist_timestamp']
+    found['hashes'] = dict(found.get('hashes', None) or {}, **{x: hashes[x] for x in elements})
+    if name in KEY_FIELDS:
+        doc[KEY_FIELDS[name]] = keys
 
 def generate_tagged(doc):
-    tagged = {}
-    tagged['studyDesign'] = tagged_item(doc, 'studyDesign')
-    tagged['briefSummary'] = tagged_item(doc, 'briefSummary')
-    tagged['briefTitle'] = tagged_item(doc, 'briefTitle')
-    tagged['officialTitle'] = tagged_item(doc, 'officialTitle')
-    tagged['detailedDescription'] = tagged_item(doc, 'detailedDescription')
-    #tagged['publications'] = tagged_item(doc, 'publications')
-    doc['tagged'] = tagged    
+    doc['tagged'] = render_tagged(doc['untagged'], doc.get('dictionaries', None), TRIAL_ELEMENTS)
     
-def tag_doc(collection, tid, ts_services, ts_url):
-    doc = collection.find_one({'ctid': tid})
-    doc_updated = False
-    tagged_dicts = doc.get('dictionaries', None)
+def tag_doc(doc, ts_services, ts_url, context):
+    # returns the update of the retagged fields, or None when the trial is up-to-date.
+    hashes = {elem: text_hash(doc['untagged'][elem]) for elem in TRIAL_ELEMENTS}
+    retag = {}
     for tservice in ts_services:
-        updated = tag_doc_dict(doc, tservice, ts_url)
-        if updated:
-            doc_updated = True
-    if doc_updated:
-        doc['timestamp'] = datetime.now()
+        elements = get_retag_elements(doc, tservice, hashes)
+        if len(elements) > 0:
+            retag[tservice['name']] = elements
+    if len(retag) == 0:
+        return None
+    matches, used = tag_elements(doc, ts_url, retag, context)
+    # the kept elements of a partial retag were tagged with the stored version, when the
+    # dictionary was reloaded since then all its elements are retagged with the new one.
+    mixed = {name: list(TRIAL_ELEMENTS) for name, elements in retag.items() \
+                if len(elements) < len(TRIAL_ELEMENTS) and not is_same_version(get_dict_entry(doc, name), used[name])}
+    if len(mixed) > 0:
+        mixed_matches, mixed_used = tag_elements(doc, ts_url, mixed, context)
+        for elem in TRIAL_ELEMENTS:
+            matches.setdefault(elem, {}).update(mixed_matches[elem])
+        used.update(mixed_used)
+        retag.update(mixed)
+    for name, elements in retag.items():
+        tag_doc_dict(doc, used[name], matches, elements, hashes, context['raw_encoding'])
+    return tagged_update(doc, retag, context)
+
+def tagged_update(doc, names, context):
+    # the update of a trial whose dictionaries in names were changed
+    doc['timestamp'] = datetime.now()
+    fields = ['dictionaries', 'timestamp']
+    fields.extend(KEY_FIELDS[x] for x in names if x in KEY_FIELDS)
+    if context['store_tagged']:
         generate_tagged(doc)
-        collection.update_one({'_id':doc['_id']}, {"$set": doc}, upsert=False)
-    return doc_updated
+        fields.append('tagged')
+        return UpdateOne({'_id':doc['_id']}, {"$set": {f: doc[f] for f in fields}}, upsert=False)
+    # the tagged text is rendered on request by the read api
+    return UpdateOne({'_id':doc['_id']}, {"$set": {f: doc[f] for f in fields}, \
+                        "$unset": {'tagged': ''}}, upsert=False)
+
+def write_tagged(collection, updates, ordered):
+    # returns the positions of the saved updates,
+    # failed trials keep their old dictionary timestamps and are retagged next time.
+    if len(updates) == 0:
+        return []
+    try:
+        collection.bulk_write(updates, ordered=ordered)
+        return list(range(len(updates)))
+    except BulkWriteError as bwe:
+        errors = bwe.details['writeErrors']
+        print (f'Error: {len(errors)} of {len(updates)} tagged trials are not saved.')
+        failed = set(x['index'] for x in errors)
+        if ordered: # an ordered bulk write stops at the first error
+            return list(range(min(failed)))
+        return [i for i in range(len(updates)) if i not in failed]
+
+def is_text_changed(doc):
+    # True when an element changed since it was tagged with any dictionary
+    hashes = {elem: text_hash(doc['untagged'][elem]) for elem in TRIAL_ELEMENTS}
+    for d_entry in doc.get('dictionaries', None) or []:
+        tagged_hashes = d_entry.get('hashes', None) or {}
+        if any(x in tagged_hashes and tagged_hashes[x] != hashes[x] for x in TRIAL_ELEMENTS):
+            return True
+    return False
 
-def tag(collection, tag_service_url):
+def trial_stats(doc):
+    stats = {}
+    words = add_trial_stats(doc, stats)
+    return stats, words
+
+def tag_doc_worker(doc, ts_services, ts_url, context):
+    # runs in the worker pool
+    return update_doc_worker(doc, context, lambda doc: tag_doc(doc, ts_services, ts_url, context))
+
+def update_doc_worker(doc, context, update_doc):
+    # a failed trial is reported and skipped.
+    # returns the update, for the statistics counters the old and new tags of the trial
+    # and for the trial index the ctid with the old and new identifiers of the trial.
+    counters = context['counters']
+    try:
+        old = None
+        if context['stat_counters']:
+            if is_text_changed(doc):
+                # the stored matches do not fit the new text, the old tags can not be counted
+                context['stat_counters'] = False
+                invalidate_counters(context['counter_collection'])
+                print (f"trial {doc.get('ctid')} changed, the statistics counters are rebuilt next.")
+            else:
+                old = trial_stats(doc)
+        old_identifiers = trial_identifiers(doc, KEY_FIELDS)
+        update = update_doc(doc)
+    except Exception as e:
+        count(counters, 'failed')
+        print (f"Error: trial {doc.get('ctid')} is not tagged: {e}")
+        return None
+    count(counters, 'trials')
+    if update:
+        count(counters, 'retagged')
+        return update, (old, trial_stats(doc)) if old else None, \
+                (doc['ctid'], old_identifiers, trial_identifiers(doc, KEY_FIELDS))
+    return None
+
+def tag(collection, tag_service_url, context):
     print (f'start tagging new trial or with new dictionary.')
-    ts_services = get_all_tagservices(tag_service_url)
-    ts_url = tag_service_url + 'tag'
-    tag_updated = False
-    for tid in get_all_trial_id(collection):
-        if tag_doc(collection, tid, ts_services, ts_url):
-            tag_updated = True
-    return tag_updated
+    context['counters'] = new_counters()
+    # the counters are only kept up to date once a full rebuild created them
+    context['stat_counters'] = context['stats_backend'] == STATS_INCREMENTAL \
+                                and has_counters(context['counter_collection'])
+    if not is_trial_index_built(context['trial_index_collection']):
+        build_trial_index(context['trial_index_collection'], collection, KEY_FIELDS)
+    ts_services = get_all_tagservices(tag_service_url, context)
+    ts_url = tag_service_url + 'tag/batch'
+    if context['delta_retag']:
+        for tservice in ts_services:
+            apply_list_diffs(collection, tservice, tag_service_url, context)
+    trials = get_trials_to_tag(collection, ts_services, context['trial_selection'])
+    size = context['bulk_write_size']
+    # every batch of trials is tagged by the pool, then saved with one bulk write
+    with ThreadPoolExecutor(max_workers=context['tag_workers']) as executor:
+        docs = list(islice(trials, size))
+        while len(docs) > 0:
+            results = executor.map(lambda doc: tag_doc_worker(doc, ts_services, ts_url, context), docs)
+            save_batch(collection, [x for x in results if x], context)
+            docs = list(islice(trials, size))
+    print_counters(context['counters'])
+    return context['counters']['saved'] > 0
+
+def save_batch(collection, batch, context):
+    saved = write_tagged(collection, [x[0] for x in batch], context['bulk_write_ordered'])
+    count(context['counters'], 'saved', len(saved))
+    if context['stat_counters']:
+        delta = new_delta()
+        for i in saved:
+            old, new = batch[i][1]
+            add_trial_delta(delta, old, new)
+        apply_delta(context['counter_collection'], delta)
+    index_delta = new_index_delta()
+    for i in saved:
+        add_trial_index_delta(index_delta, *batch[i][2])
+    apply_index_delta(context['trial_index_collection'], index_delta)
+
+'''
+Delta retagging: when only the blacklist or whitelist of a dictionary changed,
+the trials tagged with an older version are updated from the list changes:
+    trials with unblocked, newly whitelisted or unwhitelisted names are left
+        outdated and retagged as usual,
+    the matches of newly blocked words are dropped from the other trials containing them,
+    every other trial only gets the new timestamps.
+Trials are selected by a case-insensitive search of the names in their text,
+whitespace and hyphens are ignored, see normalize_name.
+'''
+def get_tagged_versions(collection, tservice):
+    # the outdated (blacklist, whitelist) versions trials are tagged with, the first
+    # stage only reads the outdated trials by index, none once they are all current.
+    name = tservice['name']
+    outdated = [{'name': name, 'blacklist_timestamp': {'$lt': tservice['blacklist_timestamp']}},
+                {'name': name, 'whitelist_timestamp': {'$lt': tservice['whitelist_timestamp']}}]
+    pipeline = [{'$match': {'$or': [{'dictionaries': {'$elemMatch': x}} for x in outdated]}},
+                {'$unwind': '$dictionaries'},
+                {'$match': {'$or': [{'dictionaries.' + k: v for k, v in x.items()} for x in outdated]}},
+                {'$group': {'_id': {'b': '$dictionaries.blacklist_timestamp', 'w': '$dictionaries.whitelist_timestamp'}}}]
+    return [(doc['_id']['b'], doc['_id']['w']) for doc in collection.aggregate(pipeline, allowDiskUse=True)]
+
+def get_list_diff(tag_service_url, tservice, version, context):
+    # the list changes from version to the tag service version, None when they are unknown
+    query = urlencode({'blacklist': version[0].isoformat(), 'whitelist': version[1].isoformat()})
+    try:
+        jr = get_json(tag_service_url + 'dictionaries/' + tservice['name'] + '/diff?' + query, context)
+    except (IOError, ValueError) as e:
+        print (f"no list changes of dictionary {tservice['name']}: {e}")
+        return None
+    parse_tagservices([jr])
+    if jr['blacklist_timestamp'] != tservice['blacklist_timestamp'] \
+        or jr['whitelist_timestamp'] != tservice['whitelist_timestamp']:
+        return None # reloaded in between
+    return jr
+
+def version_filter(name, version):
+    return {'dictionaries': {'$elemMatch': {'name': name, \
+                'blacklist_timestamp': version[0], 'whitelist_timestamp': version[1]}}}
+
+def strip_separators(name):
+    return re.sub(r'[\s\-]+', '', name)
+
+def normalize_name(name):
+    # names compare case-insensitively with whitespace and hyphens ignored,
+    # the same text names_filter finds: 'IL-6', 'il 6' and 'IL6' are equal.
+    return strip_separators(name).casefold()
+
+def names_filter(names):
+    # any whitespace or hyphens may appear between the characters of a name
+    conditions = []
+    for i in range(0, len(names), NAMES_PER_REGEX):
+        words = ['[\\s\\-]*'.join(re.escape(c) for c in strip_separators(x)) \
+                    for x in names[i:i+NAMES_PER_REGEX]]
+        pattern = '|'.join(x for x in words if x)
+        conditions.extend({'untagged.' + elem: {'$regex': pattern, '$options': 'i'}} for elem in TRIAL_ELEMENTS)
+    return {'$or': conditions}
+
+def drop_blocked(doc, tservice, blocked, context):
+    # drops the matches of blocked words, None when the text changed since tagging
+    name = tservice['name']
+    found = get_dict_entry(doc, name)
+    hashes = {elem: text_hash(doc['untagged'][elem]) for elem in TRIAL_ELEMENTS}
+    tagged_hashes = found.get('hashes', None) or {}
+    if any(x in tagged_hashes and tagged_hashes[x] != hashes[x] for x in TRIAL_ELEMENTS):
+        return None
+    matches = {}
+    for elem in TRIAL_ELEMENTS:
+        text = doc['untagged'][elem]
+        kept = [m for m in decode_matches(found, elem) if normalize_name(text[m[0]:m[1]+1]) not in blocked]
+        matches[elem] = {name: kept}
+    tag_doc_dict(doc, tservice, matches, TRIAL_ELEMENTS, hashes, context['raw_encoding'])
+    return tagged_update(doc, [name], context)
+
+def drop_blocked_trials(collection, query, tservice, blocked, context):
+    trials = collection.find(filter=query, projection={'tagged': False})
+    docs = list(islice(trials, context['bulk_write_size']))
+    while len(docs) > 0:
+        results = [update_doc_worker(doc, context, lambda doc: drop_blocked(doc, tservice, blocked, context)) \
+                    for doc in docs]
+        save_batch(collection, [x for x in results if x], context)
+        docs = list(islice(trials, context['bulk_write_size']))
+
+def apply_list_diffs(collection, tservice, tag_service_url, context):
+    name = tservice['name']
+    # the trial timestamp changes too, sync/sync.py copies trials whose timestamp changed
+    new_version = {'dictionaries.$[d].blacklist_timestamp': tservice['blacklist_timestamp'], \
+                    'dictionaries.$[d].whitelist_timestamp': tservice['whitelist_timestamp'], \
+                    'timestamp': datetime.now()}
+    for version in get_tagged_versions(collection, tservice):
+        diff = get_list_diff(tag_service_url, tservice, version, context)
+        if diff is None:
+            continue
+        rescan = diff['unblocked'] + [x[1] for x in diff['whitelisted'] + diff['unwhitelisted']]
+        blocked = set(normalize_name(x) for x in diff['blocked'])
+        # the trials that do not only get the new version
+        changed = []
+        if len(rescan) > 0:
+            changed.append(names_filter(rescan))
+        if len(blocked) > 0:
+            query = {'$and': [version_filter(name, version), names_filter(diff['blocked'])]}
+            if len(changed) > 0:
+                query['$and'].append({'$nor': list(changed)})
+            drop_blocked_trials(collection, query, tservice, blocked, context)
+            # trials whose drop failed keep the old version and are retagged as usual
+            changed.append(names_filter(diff['blocked']))
+        query = {'$and': [version_filter(name, version)]}
+        if len(changed) > 0:
+            query['$and'].append({'$nor': changed})
+        result = collection.update_many(query, {'$set': new_version}, array_filters=[{'d.name': name, \
+                    'd.blacklist_timestamp': version[0], 'd.whitelist_timestamp': version[1]}])
+        count(context['counters'], 'bumped', result.modified_count)
+        print (f"dictionary {name}: {len(blocked)} blocked, {len(rescan)} names to rescan, " \
+                f"{result.modified_count} trials only got the new version.")
+
+def create_trial_indexes(collection):
+    # the incremental selection looks trials up by dictionary name and timestamps.
+    collection.create_index('ctid')
+    collection.create_index([('dictionaries.name', 1), ('dictionaries.blacklist_timestamp', 1)])
+    collection.create_index([('dictionaries.name', 1), ('dictionaries.whitelist_timestamp', 1)])
+
+def get_outdated_filter(collection, ts_services):
+    # new trials, plus trials tagged with an older version of any dictionary
+    conditions = [{'dictionaries.name': None}]
+    # an exact count, the estimate comes from collection metadata and can
+    # be off from the index count below in either direction. The _id index
+    # hint keeps it an index scan, the trial documents are not read.
+    total = collection.count_documents({}, hint='_id_')
+    for tservice in ts_services:
+        name = tservice['name']
+        conditions.append({'dictionaries': {'$elemMatch': {'name': name, \
+            'blacklist_timestamp': {'$lt': tservice['blacklist_timestamp']}}}})
+        conditions.append({'dictionaries': {'$elemMatch': {'name': name, \
+            'whitelist_timestamp': {'$lt': tservice['whitelist_timestamp']}}}})
+        # a dictionary missing from some tagged trials can not be found by index,
+        # only pay for the scan when the index count says it is needed.
+        if collection.count_documents({'dictionaries.name': name}) < total:
+            conditions.append({'dictionaries.name': {'$ne': name}})
+    return {'$or': conditions}
+
+def get_trials_to_tag(collection, ts_services, selection):
+    if selection == SELECT_INCREMENTAL:
+        query = get_outdated_filter(collection, ts_services)
+    else:
+        query = None
+    return collection.find(filter=query, projection={'tagged': False})
 
-def get_all_tagservices(tag_service_url):
+def get_all_tagservices(tag_service_url, context):
+    # the tag service reloads changed dictionaries in the background,
+    # wait for the reload so the trials are tagged with the new dictionaries.
     url = tag_service_url + 'dictionaries/update'
-    r = requests.post(url, json={})
-    jdicts = json.loads(r.text)['dictionaries']
+    jr = post_json(url, {}, context)
+    job = jr.get('job', None)
+    if job:
+        deadline = time.time() + context['reload_wait']
+        while job['status'] == 'running' and time.time() < deadline:
+            time.sleep(1)
+            job = get_json(tag_service_url + 'dictionaries/jobs/' + job['id'], context)
+        if job['status'] == 'running':
+            print (f"dictionary reload {job['id']} is still running, tag with the loaded dictionaries.")
+        elif job['status'] == 'failed':
+            print (f"Error: dictionary reload {job['id']} failed: {job['error']}")
+        jr = get_json(tag_service_url + 'dictionaries', context)
+    return parse_tagservices(jr['dictionaries'])
+
+def parse_tagservices(jdicts):
     for item in jdicts:
         strd = item['blacklist']
         if strd and len(strd) >0:
@@ -217,22 +574,21 @@ def get_all_tagservices(tag_service_url):
             item['whitelist_timestamp'] = datetime(2020, 1, 1)
     return jdicts
 
-def get_all_trial_id(collection):
-    ctids = []
-    for doc in collection.find(filter=None, projection={'ctid': True}):
-        ctids.append(doc['ctid'])
-    return ctids
-
 def do_tag(trial_collection, tag_service_url, context):
+    tag_updated = False
     try:
-        tag_updated = tag(trial_collection, tag_service_url)
+        tag_updated = tag(trial_collection, tag_service_url, context)
     except:
         traceback.print_exc(file=sys.stdout)
     try:
         if tag_updated:
-            stat, trial_tags = update_statistics(trial_collection, context['stat_collection'] )
-            #context = {'protein_dict': protein_dict, 'cath_dict': cath_dict, 'stat_collection': stat_collection}
-            generate_visual_data(trial_tags, context)
+            if context['stats_backend'] == STATS_MONGODB:
+                update_statistics_pipeline(trial_collection, context['stat_collection'], context['top_number'])
+            elif context['stats_backend'] == STATS_INCREMENTAL:
+                update_statistics_incremental(trial_collection, context)
+            else:
+                update_statistics(trial_collection, context['stat_collection'], context['top_number'])
+            generate_visual_data(context)
         else:
             print (f'There is no update of tags.')
     except:
@@ -249,98 +605,66 @@ def read_raw_tags(rawtags, text):
             tags.append( {'word': word, 'identifiers' : identifiers} )
     return tags
 
-def read_doc_tags(tid, trial_collection):
-    doc = trial_collection.find_one({'ctid': tid})
+'''
+Running statistics of one dictionary, only distinct terms are kept:
+    { 'name' : 'protein',
+      'words' : Counter({'IL-6': 12, 'ACE2': 30}),            # mentions of each tagged word
+      'casefolded_words' : {'il-6', 'ace2'},                  # distinct words, case-insensitive
+      'identifiers' : Counter({'P05231': 12, 'Q9BYF1': 30}),  # mentions of each identifier
+      'mentioned' : Counter({'P05231': 3, 'Q9BYF1': 9})       # trials mentioning each identifier
+    }
+The trials mentioning each identifier are kept in the trialindex collection, see trialindex.py.
+'''
+def new_dict_stats(name):
+    return {'name' : name , 'words': Counter(), 'casefolded_words': set(), \
+            'identifiers': Counter(), 'mentioned' : Counter()}
+
+def add_trial_stats(doc, stats):
+    # adds the tags of one trial to the running statistics, returns its word count
     dicts = doc.get('dictionaries', None)
     untagged = doc.get('untagged', None)
-    taginfo = []
     total_words = 0
     if dicts:
         for d_entry in dicts:
-            t_info = { 'name': d_entry['name'], 'tags': [], 'ctid' : tid }
-            raw = d_entry['raw']
+            name = d_entry['name']
+            stats_dict = stats.get(name, None)
+            if stats_dict is None:
+                stats_dict = new_dict_stats(name)
+                stats[name] = stats_dict
+            mentioned = set()
             for elem in TRIAL_ELEMENTS:
                 text = untagged[elem]
-                tags = read_raw_tags(raw[elem], text)
-                t_info['tags'].extend(tags)
+                for tag in read_raw_tags(decode_matches(d_entry, elem), text):
+                    stats_dict['words'][tag['word']] += 1
+                    stats_dict['casefolded_words'].add(tag['word'].casefold())
+                    stats_dict['identifiers'].update(tag['identifiers'])
+                    mentioned.update(tag['identifiers'])
                 total_words += len(text.split())
-            taginfo.append(t_info)
-    return taginfo, total_words
+            stats_dict['mentioned'].update(mentioned)
+    return total_words
 
-'''
-trial_tags : 
-[
-    [
-        { 'name' : 'protein',
-            'tags' : [
-                {
-                    'word': 'IL-6', 
-                    'identifiers': ['A', 'B']
-                },
-                {
-                    'word': 'ACE2'
-                    'identifiers': ['C']
-                }
-            ]
-        },
-        { 'name' : 'pdb',
-            'tags' : [
-                {
-                    'word': 'vitamin D', 
-                    'identifiers': ['A', 'B']
-                },
-                {
-                    'word': 'chloroquine'
-                    'identifiers': ['A', 'C']
-                }
-            ]
-        }
-    ]
-]
-'''
-def generate_stats(trial_tags, stat_collection, total_words):
-    doc_count = len(trial_tags)
-    stats = []
-    for doc_tags in trial_tags:
-        for t_dict in doc_tags:
-            name = t_dict['name']
-            search = [x for x in stats if x['name'] == name]
-            stats_dict = None
-            if len(search) == 0:
-                stats_dict = {'name' : name , 'words':[], 'identifiers': [], 'mentioned' : []}
-                stats.append(stats_dict)
-            else :
-                stats_dict = search[0]
-            for elem in t_dict['tags']:
-                    stats_dict['words'].append( elem['word'] )
-                    stats_dict['identifiers'].extend(elem['identifiers'])
-            mentioned = set (chain.from_iterable(w['identifiers'] for w in t_dict['tags']))
-            stats_dict['mentioned'].extend( mentioned )    
-    # start aggregating
-    for stats_dict in stats:
+def generate_stats(stats, doc_count, total_words, stat_collection, top_number=TOP_NUMBER):
+    # the top lists keep their top200_ names whatever the top_number is
+    for stats_dict in stats.values():
         stat = {'total_trials': doc_count, 'total_words' : total_words}
-        stat['total_tagged_words'] = len(stats_dict['words'])
-        dist_words = set({v.casefold(): v for v in stats_dict['words']}.values()) 
+        total_tagged = sum(stats_dict['words'].values())
+        stat['total_tagged_words'] = total_tagged
+        dist_words = stats_dict['casefolded_words']
         stat['distinct_tagged_words_case_insensitive'] = len(dist_words)
         if doc_count >0:
-            stat['average_tagged_words_per_trial'] = float(len(stats_dict['words'])) / doc_count
+            stat['average_tagged_words_per_trial'] = float(total_tagged) / doc_count
             stat['average_distinct_tagged_words_per_trial'] = float(len(dist_words)) / doc_count
-        stat['top200_tagged_words'] =  Counter(stats_dict['words']).most_common(TOP_NUMBER) 
-        stat[TOTAL_IDENTIFIERS] = len(stats_dict['identifiers'])
-        dist_identifiers = set (stats_dict['identifiers'])
+        stat['top200_tagged_words'] =  stats_dict['words'].most_common(top_number)
+        total_identifiers = sum(stats_dict['identifiers'].values())
+        stat[TOTAL_IDENTIFIERS] = total_identifiers
+        dist_identifiers = stats_dict['identifiers']
         stat['distinct_identifiers'] = len(dist_identifiers)
         if doc_count >0:
-            stat['average_identifiers_per_trial'] = float(len(stats_dict['identifiers'])) / doc_count
+            stat['average_identifiers_per_trial'] = float(total_identifiers) / doc_count
             stat['average_distinct_identifiers_per_trial'] = float(len(dist_identifiers)) / doc_count
-        #top200_identifiers = Counter(stats_dict['identifiers']).most_common(TOP_NUMBER)
-        #identifiers_mentioned = list(Counter(stats_dict['mentioned']).items())
-        top200_identifiers = Counter(stats_dict['mentioned']).most_common(TOP_NUMBER)
-        identifiers_appeared = list(Counter(stats_dict['identifiers']).items())
         top_ids = []
-        for item in top200_identifiers:
-            identifier = item[0]
-            search = [x for x in identifiers_appeared if x[0] == identifier]
-            top_ids.append( { identifier : {'trials': item[1], 'tags': search[0][1]} })
+        for identifier, trials in stats_dict['mentioned'].most_common(top_number):
+            top_ids.append( { identifier : {'trials': trials, 'tags': dist_identifiers[identifier]} })
         stat['top200_identifiers'] =  top_ids
         save_statistics(stat, stats_dict['name'], stat_collection)
     return stats
@@ -349,16 +673,54 @@ def save_statistics(data, name, stat_collection) :
     doc = {'name':name, 'data': data, 'timestamp': datetime.now()}
     stat_collection.update_one({'name':name}, {"$set": doc }, upsert=True)
 
-def update_statistics(trial_collection, stat_collection):
-    print (f'start updating statistics...')
-    trial_tags = []
+def read_statistics(trial_collection):
+    # one projected cursor over the trials, only running counters are kept in memory
+    stats = {}
     total_words = 0
-    for tid in get_all_trial_id(trial_collection):
-        tags, word_count = read_doc_tags(tid, trial_collection)
-        trial_tags.append( tags )
-        total_words += word_count
+    doc_count = 0
+    projection = {'dictionaries.name': True, 'dictionaries.raw': True, 'dictionaries.entities': True}
+    projection.update({'untagged.' + elem: True for elem in TRIAL_ELEMENTS})
+    for doc in trial_collection.find(filter=None, projection=projection):
+        doc_count += 1
+        total_words += add_trial_stats(doc, stats)
+    return stats, doc_count, total_words
+
+def update_statistics(trial_collection, stat_collection, top_number=TOP_NUMBER):
+    print (f'start updating statistics...')
+    stats, doc_count, total_words = read_statistics(trial_collection)
+    print (f'end updating statistics.')
+    return generate_stats(stats, doc_count, total_words, stat_collection, top_number)
+
+def update_statistics_pipeline(trial_collection, stat_collection, top_number=TOP_NUMBER):
+    # same statistics as update_statistics, counted by aggregation pipelines in MongoDB
+    print (f'start updating statistics with aggregation pipelines...')
+    doc_count, total_words = aggregate_totals(trial_collection, TRIAL_ELEMENTS)
+    stats = {}
+    for name in trial_collection.distinct('dictionaries.name'):
+        stats[name] = new_dict_stats(name)
+        aggregate_dictionary(trial_collection, name, TRIAL_ELEMENTS, stats[name])
     print (f'end updating statistics.')
-    return generate_stats(trial_tags, stat_collection, total_words), trial_tags
+    return generate_stats(stats, doc_count, total_words, stat_collection, top_number)
+
+def update_statistics_incremental(trial_collection, context):
+    # the counters are updated while trials are retagged, the trials are only
+    # read again by the first and the periodic rebuilds.
+    counter_collection = context['counter_collection']
+    if is_rebuild_due(counter_collection, context['stats_rebuild_interval']):
+        print (f'start rebuilding statistics counters...')
+        stats, doc_count, total_words = read_statistics(trial_collection)
+        rebuild_counters(counter_collection, stats, total_words)
+    else:
+        print (f'start updating statistics from counters...')
+        stats, total_words = read_counters(counter_collection, new_dict_stats)
+        # a dictionary without any tag left has no counters
+        for name in trial_collection.distinct('dictionaries.name'):
+            if name not in stats:
+                stats[name] = new_dict_stats(name)
+        doc_count = trial_collection.estimated_document_count()
+    print (f'end updating statistics.')
+    return generate_stats(stats, doc_count, total_words, context['stat_collection'], \
+                        context['top_number'])
 
 def get_db(config):
     uri = config.get(CONFIG_SECTION, 'mongodb_uri')
@@ -368,6 +730,18 @@ def get_db(config):
     print (f'\tdatabase: {dbname}')
     return c[dbname]
 
+def get_http_session(config):
+    # one keep-alive session with a connection pool for every tag service call,
+    # responses are gzip compressed on request (Accept-Encoding) by requests.
+    pool_size = config.getint(CONFIG_SECTION, 'http_pool_size', \
+                    fallback=config.getint(CONFIG_SECTION, 'tag_workers', fallback=1))
+    print (f'.. http connection pool size: {pool_size}')
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 def read_config():
     config = configparser.ConfigParser()
     config.read('tag.cfg')
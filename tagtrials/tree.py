@@ -0,0 +1,40 @@
+import json
+from datetime import datetime
+
+'''
+Builder of the sunburst trees of the visualisations,
+    { 'name' : 'statistics', 'children' : [ { 'name' : '1', 'children' : [ ... ] } ] }
+with an index from the path of every inner node to the node,
+    { () : root, ('1',) : node of 1, ('1', '1.20') : node of 1.20 }
+so a node is found or added in constant time whatever the number of its siblings.
+Children keep the order they were added in.
+'''
+def new_tree(name='statistics'):
+    root = {'name': name, 'children': []}
+    return {'root': root, 'nodes': {(): root}}
+
+def tree_node(tree, path):
+    # returns the node at path, missing nodes on the way are added
+    node = tree['nodes'].get(path, None)
+    if node is None:
+        parent = tree_node(tree, path[:-1])
+        node = {'name': path[-1], 'children': []}
+        parent['children'].append(node)
+        tree['nodes'][path] = node
+    return node
+
+def add_leaf(tree, path, leaf):
+    tree_node(tree, path)['children'].append(leaf)
+
+def visual_data(tree, file_name):
+    # the root becomes the visualfile document as it is, see save_visual_data
+    v_data = tree['root']
+    v_data['file'] = file_name
+    v_data['timestamp'] = datetime.now()
+    return v_data
+
+def write_tree(tree, path):
+    # the json is written in chunks while it is encoded
+    with open(path, 'w') as outfile:
+        for chunk in json.JSONEncoder(default=str).iterencode(tree['root']):
+            outfile.write(chunk)
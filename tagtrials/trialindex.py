@@ -0,0 +1,83 @@
+from datetime import datetime
+
+from pymongo import UpdateOne, InsertOne, DeleteOne
+
+'''
+Inverted index of the tagged trials, one document per identifier of every
+dictionary with the trials mentioning it:
+    { 'name' : 'protein', 'identifier' : 'P05231', 'ctids' : ['NCT04280705', 'NCT04315298'] }
+and one document written when a full build is complete:
+    { 'name' : '*', 'identifier' : '*', 'built' : datetime }
+The identifiers of a trial are its key field lists (see KEY_FIELDS in tag.py),
+the index is updated with $addToSet and $pull for every saved retagged trial.
+'''
+BUILT_FILTER = {'name': '*', 'identifier': '*'}
+WRITE_SIZE = 1000
+
+def create_trial_index_indexes(index_collection):
+    index_collection.create_index([('name', 1), ('identifier', 1)], unique=True)
+
+def is_trial_index_built(index_collection):
+    return index_collection.find_one(BUILT_FILTER) is not None
+
+def trial_identifiers(doc, key_fields):
+    # { dictionary name: set of identifiers } of one trial
+    return {name: set(doc.get(field, None) or []) for name, field in key_fields.items()}
+
+def new_index_delta():
+    return {'added': {}, 'removed': {}}
+
+def add_trial_index_delta(delta, ctid, old, new):
+    # old and new are the trial identifiers before and after retagging
+    for name in set(old) | set(new):
+        old_ids = old.get(name, set())
+        new_ids = new.get(name, set())
+        for identifier in new_ids - old_ids:
+            delta['added'].setdefault((name, identifier), []).append(ctid)
+        for identifier in old_ids - new_ids:
+            delta['removed'].setdefault((name, identifier), []).append(ctid)
+
+def apply_index_delta(index_collection, delta):
+    updates = []
+    for (name, identifier), ctids in delta['added'].items():
+        updates.append(UpdateOne({'name': name, 'identifier': identifier}, \
+                        {'$addToSet': {'ctids': {'$each': ctids}}}, upsert=True))
+    for (name, identifier), ctids in delta['removed'].items():
+        updates.append(UpdateOne({'name': name, 'identifier': identifier}, \
+                        {'$pull': {'ctids': {'$in': ctids}}}))
+    for i in range(0, len(updates), WRITE_SIZE):
+        index_collection.bulk_write(updates[i:i+WRITE_SIZE], ordered=False)
+    # only the identifiers that lost trials can have become empty, each is looked up by the unique index
+    deletes = [DeleteOne({'name': name, 'identifier': identifier, 'ctids': {'$size': 0}}) \
+                for (name, identifier) in delta['removed']]
+    for i in range(0, len(deletes), WRITE_SIZE):
+        index_collection.bulk_write(deletes[i:i+WRITE_SIZE], ordered=False)
+    return len(updates)
+
+def build_trial_index(index_collection, trial_collection, key_fields):
+    # the built document is removed first and written last, an interrupted
+    # build is started again by the next tagging run.
+    print (f'start building the trial index...')
+    index_collection.delete_one(BUILT_FILTER)
+    index_collection.delete_many({})
+    projection = {'_id': False, 'ctid': True}
+    projection.update({field: True for field in key_fields.values()})
+    index = {}
+    for doc in trial_collection.find(projection=projection):
+        for name, identifiers in trial_identifiers(doc, key_fields).items():
+            for identifier in identifiers:
+                index.setdefault((name, identifier), []).append(doc['ctid'])
+    inserts = [InsertOne({'name': name, 'identifier': identifier, 'ctids': ctids}) \
+                for (name, identifier), ctids in index.items()]
+    for i in range(0, len(inserts), WRITE_SIZE):
+        index_collection.bulk_write(inserts[i:i+WRITE_SIZE], ordered=False)
+    index_collection.insert_one(dict(BUILT_FILTER, built=datetime.now()))
+    print (f'end building the trial index, {len(inserts)} identifiers.')
+
+def read_trial_index(index_collection, name, identifiers=None):
+    # returns { identifier: sorted ctids } of a dictionary, of all its identifiers when None
+    query = {'name': name}
+    if identifiers is not None:
+        query['identifier'] = {'$in': list(identifiers)}
+    return {doc['identifier']: sorted(doc['ctids']) \
+            for doc in index_collection.find(query, projection={'_id': False})}
@@ -1,8 +1,100 @@
-def generate_chembl_visual_data(trial_tags, doc, context):
-    return None
+from preferred import get_preferred
+from tree import new_tree, tree_node, add_leaf, visual_data
+from trialindex import read_trial_index
 
-def generate_pdb_visual_data(trial_tags, doc, context):
-    return None    
+'''
+Compound visualisations, the top identifiers of a dictionary grouped by the
+pubchem clusters of the chemical cluster collection (see analysis/load_pubchem_cluster.py):
+    { 'name' : 'chembl2pubchem', 'data' : { 'CHEMBL25' : '2244', ... } }    # one or more documents
+    { 'name' : 'pubchem_cluster', 'data' : [ { 'pubchem_id' : '2244', 'clusters' : ['U.Clus.3'], ... } ] }
+Both are read into dicts once per visualisation run.
+'''
+def load_chembl2pubchem(cluster_collection):
+    mapping = {}
+    for record in cluster_collection.find({'name': 'chembl2pubchem'}, projection={'_id': False, 'data': True}):
+        mapping.update(record['data'])
+    return mapping
 
-def generate_pubchem_visual_data(trial_tags, doc, context):
-    return None
\ No newline at end of file
+def load_pubchem_clusters(cluster_collection):
+    record = cluster_collection.find_one({'name': 'pubchem_cluster'}, sort=[('timestamp', -1)], \
+                projection={'_id': False, 'data.pubchem_id': True, 'data.clusters': True})
+    if record is None:
+        return {}
+    return {x['pubchem_id']: x['clusters'] for x in record['data']}
+
+def get_top_leaves(doc, name, context):
+    # (identifier, preferred name, trials, ctids) of the top identifiers, looked up at once
+    identifiers = doc['data']['top200_identifiers']
+    keys = [key for idf in identifiers for key in idf]
+    trial_map = read_trial_index(context['trial_index_collection'], name, keys)
+    leaves = []
+    for idf in identifiers:
+        for key in idf:
+            compound = get_preferred(context['preferred'], name, key) or key
+            leaves.append((key, compound, idf[key]['trials'], trial_map.get(key, [])))
+    return leaves
+
+def get_tooltip_trials(size, trials):
+    info = '<p>Total number of clinical trials mentioning this compound: ' + str(size) + '</p>'
+    info += '<p>List of trials mentioning this compound: '
+    info += ', '.join('<a href="https://ClinicalTrials.gov/ct2/show/record/' + ctid + '"><strong>' + ctid + '</strong></a>' \
+                    for ctid in trials)
+    info += '</p>'
+    return info
+
+def get_pubchem_tooltip(pubchem_id, compound, label, size, trials):
+    content = ''
+    if len(pubchem_id)>0:
+        content += '<div class="tipimgdiv"><img src="https://pubchem.ncbi.nlm.nih.gov/image/imgsrv.fcgi?cid=' + pubchem_id + '&amp;t=l" /></div>'
+    content += '<p><strong>' + compound
+    if label:
+        content += ', ' + label
+    if len(pubchem_id)>0:
+        content += ', ' + '<a href="https://pubchem.ncbi.nlm.nih.gov/compound/' + pubchem_id + '" >PubChem-' + pubchem_id + '</a>'
+    content += '</strong></p>'
+    return content + get_tooltip_trials(size, trials)
+
+def get_pdb_tooltip(key, compound, size, trials):
+    content = '<p><strong>' + compound + ', <a href="https://www.rcsb.org/ligand/' + key + '" >PDB-' + key + '</a></strong></p>'
+    return content + get_tooltip_trials(size, trials)
+
+def add_cluster_leaf(tree, clusters, leaf):
+    if clusters:
+        for cltr in clusters:
+            add_leaf(tree, (cltr,), leaf)
+    else:
+        add_leaf(tree, ('unknown',), leaf)
+
+def generate_chembl_visual_data(doc, context):
+    cluster_collection = context['cluster_collection']
+    chembl2pubchem = load_chembl2pubchem(cluster_collection)
+    pubchem_clusters = load_pubchem_clusters(cluster_collection)
+    tree = new_tree()
+    tree_node(tree, ('unknown',))
+    for key, compound, size, trials in get_top_leaves(doc, 'chembl', context):
+        pubchem_id = chembl2pubchem.get(key, '')
+        leaf = {'chembl': key, 'name': compound, 'size': size}
+        if len(pubchem_id)>0:
+            leaf['pubchem'] = pubchem_id
+        leaf['tooltip'] = get_pubchem_tooltip(pubchem_id, compound, key, size, trials)
+        add_cluster_leaf(tree, pubchem_clusters.get(pubchem_id, None), leaf)
+    return visual_data(tree, 'chembl_cluster.json')
+
+def generate_pdb_visual_data(doc, context):
+    # there is no cluster data of the pdb ligands, they are leaves of the root
+    tree = new_tree()
+    for key, compound, size, trials in get_top_leaves(doc, 'pdb', context):
+        leaf = {'pdb': key, 'name': compound, 'size': size}
+        leaf['tooltip'] = get_pdb_tooltip(key, compound, size, trials)
+        add_leaf(tree, (), leaf)
+    return visual_data(tree, 'pdb_ligand.json')
+
+def generate_pubchem_visual_data(doc, context):
+    pubchem_clusters = load_pubchem_clusters(context['cluster_collection'])
+    tree = new_tree()
+    tree_node(tree, ('unknown',))
+    for key, compound, size, trials in get_top_leaves(doc, 'pubchem', context):
+        leaf = {'pubchem': key, 'name': compound, 'size': size}
+        leaf['tooltip'] = get_pubchem_tooltip(key, compound, None, size, trials)
+        add_cluster_leaf(tree, pubchem_clusters.get(key, None), leaf)
+    return visual_data(tree, 'pubchem_cluster.json')